@@ -4,28 +4,44 @@ import json
 import logging
 import tempfile
 import shutil
-from autotable import AutoTable
-from extraction import extract_tables_from_docx, extract_content_to_json
-from llm_clients import APIClient, OllamaClient
+import hashlib
+import functools
+import atexit
+import threading
 import config
+from concurrent.futures import ThreadPoolExecutor
 
 import socket
 from datetime import datetime
 import time
 
+@st.cache_data(ttl=3600, show_spinner=False)
 def get_local_ip():
+    """获取本机局域网 IP，结果缓存一小时，避免每次重跑都建立 socket"""
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # 连接外部地址以获取准确的局域网IP（不会实际发送数据）
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
+        # 用 with 保证连接失败时 socket 也会被关闭
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            # 连接外部地址以获取准确的局域网IP（不会实际发送数据）
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
     except Exception:
         return "127.0.0.1"
 
+@st.cache_resource(show_spinner=False)
+def get_llm_client(run_mode, base_url, api_key, model_name, use_response_cache=True):
+    """按配置缓存 LLM 客户端，跨重跑和会话复用同一实例"""
+    from llm_clients import APIClient, OllamaClient, CachedLLMClient
+    if run_mode == "api":
+        client = APIClient(base_url, api_key, model_name)
+    else:
+        client = OllamaClient(base_url, model_name)
+    if use_response_cache:
+        client = CachedLLMClient(client, LLM_RESPONSE_CACHE_DIR)
+    return client
+
+@st.cache_resource(show_spinner=False)
 def setup_logging():
-    # 配置根日志记录器
+    # 每个进程只需配置一次根日志记录器
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.INFO)
     
@@ -35,36 +51,267 @@ def setup_logging():
         console_handler.setLevel(logging.INFO)
         root_logger.addHandler(console_handler)
 
-def save_to_history(source_path, target_filename, history_dir="history", max_records=10):
-    """保存文件到历史记录，并自动清理旧记录"""
+@st.cache_resource(show_spinner=False)
+def _session_dirs():
+    """本进程创建过的会话目录，进程退出时统一删除"""
+    dirs = set()
+    atexit.register(lambda: [shutil.rmtree(d, ignore_errors=True) for d in list(dirs)])
+    return dirs
+
+def get_session_dir():
+    """当前会话专用的临时目录，用于保存上传的知识库文件"""
+    session_dir = st.session_state.get("session_dir")
+    if not session_dir or not os.path.isdir(session_dir):
+        session_dir = tempfile.mkdtemp(prefix="autotable_")
+        _session_dirs().add(session_dir)
+        st.session_state.session_dir = session_dir
+    return session_dir
+
+def save_uploaded_file(uploaded_file, path):
+    """将上传的文件写入磁盘；getbuffer() 直接引用上传内容所在的内存，不产生额外副本"""
+    # 用完立即释放 memoryview，否则底层 BytesIO 会被锁定无法调整大小
+    with uploaded_file.getbuffer() as view, open(path, "wb") as f:
+        f.write(view)
+
+def _scan_dir(directory, suffix):
+    """返回目录下指定后缀的文件 [(文件名, 修改时间)]，按修改时间从旧到新排序"""
+    # scandir 的 DirEntry 自带 stat 信息，避免 listdir + getmtime 的重复系统调用
+    with os.scandir(directory) as it:
+        entries = [(e.name, e.stat().st_mtime) for e in it if e.name.endswith(suffix) and e.is_file()]
+    entries.sort(key=lambda x: x[1])
+    return entries
+
+def _trim_dir(directory, suffix, max_records):
+    """按修改时间清理目录，只保留最新的 max_records 个文件"""
+    entries = _scan_dir(directory, suffix)
+    
+    # 如果超过限制，删除最老的
+    num_to_delete = len(entries) - max_records
+    for file_to_delete, _ in entries[:max(num_to_delete, 0)]:
+        try:
+            os.remove(os.path.join(directory, file_to_delete))
+            logging.info(f"Deleted old file: {file_to_delete}")
+        except Exception as e:
+            logging.error(f"Failed to delete old file {file_to_delete}: {e}")
+
+def read_file_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+HISTORY_DIR = "history"
+HISTORY_INDEX_FILE = "_index.json"
+
+def _load_history_index(history_dir):
+    """读取历史索引（文件名列表，最老在前）；索引缺失或损坏时按修改时间重建"""
+    index_path = os.path.join(history_dir, HISTORY_INDEX_FILE)
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            names = json.load(f)
+        if isinstance(names, list):
+            return names
+    except (OSError, ValueError):
+        pass
+    if not os.path.isdir(history_dir):
+        return []
+    return [name for name, _ in _scan_dir(history_dir, ".docx")]
+
+def _save_history_index(history_dir, names):
+    """先写临时文件再 os.replace，保证索引文件始终完整"""
+    index_path = os.path.join(history_dir, HISTORY_INDEX_FILE)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(names, f, ensure_ascii=False)
+    os.replace(tmp_path, index_path)
+
+@st.cache_resource(show_spinner=False)
+def _history_state():
+    """进程级共享的历史索引（内存副本）与锁；后台任务可能同时归档结果"""
+    return {"lock": threading.Lock(), "index": {}}
+
+def _get_history_index(history_dir):
+    """返回内存中的历史索引，首次访问时从磁盘加载；调用方需持有锁"""
+    indexes = _history_state()["index"]
+    if history_dir not in indexes:
+        indexes[history_dir] = _load_history_index(history_dir)
+    return indexes[history_dir]
+
+def save_to_history(source_path, target_filename, history_dir=HISTORY_DIR, max_records=10):
+    """保存文件到历史记录，并自动清理旧记录，返回历史文件路径"""
     if not os.path.exists(history_dir):
         os.makedirs(history_dir)
     
-    # 复制新文件
+    # 优先创建硬链接（同一文件系统下无需复制数据），失败时回退为复制
     target_path = os.path.join(history_dir, target_filename)
-    shutil.copy(source_path, target_path)
-    
-    # 获取所有 .docx 文件
-    files = [f for f in os.listdir(history_dir) if f.endswith(".docx")]
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
     
-    # 如果超过限制，删除最老的
-    if len(files) > max_records:
-        # 按修改时间排序，最老的在前
-        files.sort(key=lambda x: os.path.getmtime(os.path.join(history_dir, x)))
-        
-        # 计算需要删除的数量
-        num_to_delete = len(files) - max_records
-        
-        for i in range(num_to_delete):
-            file_to_delete = files[i]
+    # 索引按生成顺序记录文件名，超出上限时从头部淘汰，无需逐个 stat 排序
+    with _history_state()["lock"]:
+        names = _get_history_index(history_dir)
+        if target_filename in names:
+            names.remove(target_filename)
+        names.append(target_filename)
+        while len(names) > max_records:
+            file_to_delete = names.pop(0)
             try:
                 os.remove(os.path.join(history_dir, file_to_delete))
                 logging.info(f"Deleted old history file: {file_to_delete}")
+            except FileNotFoundError:
+                pass
             except Exception as e:
                 logging.error(f"Failed to delete old history file {file_to_delete}: {e}")
+        _save_history_index(history_dir, names)
+    return target_path
+
+def list_history(history_dir=HISTORY_DIR):
+    """列出历史记录文件名（最新在前），读取内存索引，不访问磁盘"""
+    with _history_state()["lock"]:
+        return list(reversed(_get_history_index(history_dir)))
+
+# Word 知识库提取结果缓存（相同文件 + 模型 + 提示词版本 直接复用）
+EXTRACT_CACHE_DIR = "llm_cache"
+EXTRACT_CACHE_TTL = 7 * 24 * 3600
+EXTRACT_CACHE_MAX_RECORDS = 50
+EXTRACT_PROMPT_VERSION = "v1"
+
+# LLM 响应缓存（相同请求直接复用回复）
+LLM_RESPONSE_CACHE_DIR = os.path.join(EXTRACT_CACHE_DIR, "responses")
+LLM_RESPONSE_CACHE_MAX_RECORDS = 500
+
+def _new_digest():
+    """内容摘要统一使用 BLAKE2b（128 位）：仅用于缓存键，比 SHA-256 更快且无需额外依赖"""
+    return hashlib.blake2b(digest_size=16)
+
+def file_digest(fileobj):
+    """分块计算文件对象的摘要，避免 getvalue() 复制整个文件"""
+    fileobj.seek(0)
+    if hasattr(hashlib, "file_digest"):
+        digest = hashlib.file_digest(fileobj, _new_digest)
+    else:
+        digest = _new_digest()
+        for chunk in iter(lambda: fileobj.read(1 << 20), b""):
+            digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def get_extract_cache_path(kb_digest, client, cache_dir=EXTRACT_CACHE_DIR):
+    """
+    根据文件摘要、后端类型、服务地址、模型名称和提示词版本生成缓存文件路径
+    （与 CachedLLMClient 的缓存键一致，不同后端或服务地址上的同名模型不共用缓存）
+    """
+    from llm_clients import CachedLLMClient
+    backend = client.client if isinstance(client, CachedLLMClient) else client
+    endpoint = getattr(backend, "api_base_url", None) or getattr(backend, "host", None)
+    model_name = getattr(backend, "model_name", None)
+    digest = _new_digest()
+    digest.update(f"{kb_digest}-{type(backend).__name__}-{endpoint}-{model_name}-{EXTRACT_PROMPT_VERSION}".encode("utf-8"))
+    return os.path.join(cache_dir, f"{digest.hexdigest()}.json")
+
+def load_extract_cache(cache_path, target_path, ttl=EXTRACT_CACHE_TTL):
+    """命中未过期的缓存时复制到目标路径，返回是否命中"""
+    try:
+        if time.time() - os.path.getmtime(cache_path) > ttl:
+            return False
+        shutil.copyfile(cache_path, target_path)
+        # 刷新修改时间，使清理按最近使用顺序进行
+        os.utime(cache_path)
+        return True
+    except OSError:
+        return False
+
+def save_extract_cache(source_path, cache_path, max_records=EXTRACT_CACHE_MAX_RECORDS):
+    """保存提取结果到缓存，并自动清理旧缓存"""
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        shutil.copyfile(source_path, cache_path)
+        _trim_dir(cache_dir, ".json", max_records)
+    except OSError as e:
+        logging.error(f"Failed to save extract cache: {e}")
+
+# 后台处理线程数（同一进程内所有会话共享）
+PIPELINE_WORKERS = 4
+# 处理进行中时页面轮询刷新的间隔（秒）
+PIPELINE_POLL_INTERVAL = 0.5
+
+@st.cache_resource(show_spinner=False)
+def get_pipeline_executor():
+    """进程级共享的后台线程池，LLM 处理在其中执行，不阻塞页面脚本"""
+    executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="autotable")
+    atexit.register(executor.shutdown, wait=False, cancel_futures=True)
+    return executor
+
+def run_pipeline(kb_info, template_file, work_dir, client, max_workers, progress, use_cache=True):
+    """后台执行知识库提取与填表，返回结果字典
+
+    运行在工作线程中，不能调用 Streamlit 接口；当前阶段写入 progress["stage"] 供页面轮询显示。
+    template_file 为模板文件对象（直接交给 python-docx 读取，不落盘）；work_dir 中的临时文件在结束后删除。
+    """
+    # 按需导入：docx/openpyxl/requests 等依赖只在真正处理时加载，避免拖慢页面交互
+    from autotable import AutoTable
+    from extraction import extract_content_to_json, has_extraction_errors
+
+    result = {"file": None, "extracted": None, "cache_hit": False, "error": None}
+    try:
+        # 1. 如果是 Word 知识库，先提取
+        final_kb_path = kb_info["path"]
+        if kb_info["type"] == "docx":
+            progress["stage"] = "🔍 正在分析文档内容..."
+            json_kb_path = os.path.join(work_dir, "extracted.json")
+            cache_path = get_extract_cache_path(kb_info["digest"], client)
+            # 未勾选“复用 LLM 缓存结果”时跳过读取，强制重新提取；成功后仍刷新缓存
+            if use_cache and load_extract_cache(cache_path, json_kb_path):
+                result["cache_hit"] = True
+            else:
+                if not extract_content_to_json(kb_info["path"], json_kb_path, client, max_workers=max_workers):
+                    result["error"] = "知识库提取失败"
+                    return result
+            final_kb_path = json_kb_path
+
+            # 保存提取的 JSON 数据供页面展示
+            try:
+                with open(final_kb_path, "r", encoding="utf-8") as f:
+                    result["extracted"] = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"无法读取中间数据: {e}")
+
+            if not result["cache_hit"]:
+                # 只缓存完整的提取结果：有分段请求失败（如网络中断）时下次重新提取，而不是长期复用不完整的结果
+                if result["extracted"] is not None and not has_extraction_errors(result["extracted"]):
+                    save_extract_cache(json_kb_path, cache_path)
+                else:
+                    logging.warning("提取结果包含失败的分段，不写入提取缓存")
 
-def load_css():
-    st.markdown("""
+        # 2. 运行 AutoTable
+        progress["stage"] = "🤖 正在智能填表..."
+        # 输出目录直接建在历史目录下，保证与历史记录同一文件系统，归档时只需建立硬链接
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=HISTORY_DIR, prefix=".pending_") as temp_output_dir:
+            at = AutoTable(final_kb_path, template_file, client, temp_output_dir, max_workers=max_workers)
+            if not at.run():
+                result["error"] = "填表过程出错"
+                return result
+            # 直接使用 AutoTable 记录的输出路径，无需再扫描输出目录
+            if not at.output_path or not os.path.exists(at.output_path):
+                result["error"] = "未生成文件"
+                return result
+            result_file = os.path.basename(at.output_path)
+            history_path = save_to_history(at.output_path, result_file)
+            # 只记录路径，下载时再从历史目录读取
+            result["file"] = (result_file, history_path)
+        return result
+    except Exception as e:
+        logging.error(f"处理失败: {e}")
+        result["error"] = f"发生错误: {str(e)}"
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if os.path.isdir(LLM_RESPONSE_CACHE_DIR):
+            _trim_dir(LLM_RESPONSE_CACHE_DIR, ".json", LLM_RESPONSE_CACHE_MAX_RECORDS)
+
+_CSS = """
         <style>
         /* 全局深色背景 */
         .stApp {
@@ -193,32 +440,64 @@ def load_css():
         /* 隐藏页脚 */
         footer {visibility: hidden;}
         </style>
-    """, unsafe_allow_html=True)
+"""
 
-def render_step_indicator(current_step):
-    steps = [
-        {"id": 1, "label": "1. 选择来源"},
-        {"id": 2, "label": "2. 上传知识库"},
-        {"id": 3, "label": "3. 填表生成"}
-    ]
-    
+_DESCRIPTION_HTML = """
+<div class='description-text'>
+    基于大语言模型的自动化文档填充工具，支持 Word/Excel 智能数据提取与回填<br>
+    让 AI 帮你完成繁琐的表格填写工作
+</div>
+"""
+
+# 样式、标题与副标题预先拼接为一段 HTML，每次重跑只产生一条前端消息
+_HEADER_HTML = _CSS + "<h1>智能填表助手</h1>" + _DESCRIPTION_HTML
+
+def render_header():
+    st.markdown(_HEADER_HTML, unsafe_allow_html=True)
+
+_STEPS = (
+    (1, "1. 选择来源"),
+    (2, "2. 上传知识库"),
+    (3, "3. 填表生成")
+)
+
+def _build_step_indicator_html(current_step):
     html = '<div class="step-indicator">'
-    for step in steps:
+    for step_id, label in _STEPS:
         status_class = ""
         icon = ""
-        if current_step == step["id"]:
+        if current_step == step_id:
             status_class = "active"
             icon = "🔷"
-        elif current_step > step["id"]:
+        elif current_step > step_id:
             status_class = "completed"
             icon = "✅"
         else:
             icon = "⚪"
         
-        html += f'<div class="step {status_class}">{icon} {step["label"]}</div>'
+        html += f'<div class="step {status_class}">{icon} {label}</div>'
     html += '</div>'
-    
-    st.markdown(html, unsafe_allow_html=True)
+    return html
+
+# 每个步骤的指示条 HTML 在模块加载时预先生成，重跑时直接查表
+_STEP_INDICATOR_HTML = {step_id: _build_step_indicator_html(step_id) for step_id, _ in _STEPS}
+
+def render_step_indicator(current_step):
+    st.markdown(_STEP_INDICATOR_HTML[current_step], unsafe_allow_html=True)
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# session state 默认值
+# kb_file_data: {'name': str, 'path': str, 'digest': str, 'type': str}
+# pipeline: {'future': Future, 'progress': dict}
+_SESSION_DEFAULTS = (
+    ("current_step", 1),
+    ("kb_source_type", "上传 Excel 文件"),
+    ("kb_file_data", None),
+    ("processed_file", None),
+    ("pipeline", None),
+    ("run_result", None)
+)
 
 def main():
     st.set_page_config(
@@ -228,17 +507,9 @@ def main():
         initial_sidebar_state="expanded"
     )
     
-    load_css()
-    
     # 初始化 session state
-    if 'current_step' not in st.session_state:
-        st.session_state.current_step = 1
-    if 'kb_source_type' not in st.session_state:
-        st.session_state.kb_source_type = "上传 Excel 文件"
-    if 'kb_file_data' not in st.session_state:
-        st.session_state.kb_file_data = None # {'name': str, 'data': bytes}
-    if 'processed_file' not in st.session_state:
-        st.session_state.processed_file = None 
+    for key, default in _SESSION_DEFAULTS:
+        st.session_state.setdefault(key, default)
         
     setup_logging()
 
@@ -253,13 +524,26 @@ def main():
                 help="选择使用在线 API 或本地 Ollama 模型"
             )
             
-            if run_mode == "api":
-                api_base_url = st.text_input("API Base URL", value=config.API_BASE_URL)
-                api_key = st.text_input("API Key", value=config.API_KEY, type="password")
-                api_model = st.text_input("Model Name", value=config.API_MODEL_NAME)
-            else:
-                ollama_host = st.text_input("Ollama Host", value=config.OLLAMA_HOST)
-                ollama_model = st.text_input("Ollama Model", value=config.OLLAMA_MODEL_NAME)
+            # 连接参数放在表单中：编辑时不触发重跑，点击“应用配置”后统一生效
+            with st.form("llm_cfg", border=False):
+                if run_mode == "api":
+                    api_base_url = st.text_input("API Base URL", value=config.API_BASE_URL)
+                    api_key = st.text_input("API Key", value=config.API_KEY, type="password")
+                    api_model = st.text_input("Model Name", value=config.API_MODEL_NAME)
+                else:
+                    ollama_host = st.text_input("Ollama Host", value=config.OLLAMA_HOST)
+                    ollama_model = st.text_input("Ollama Model", value=config.OLLAMA_MODEL_NAME)
+                max_workers = st.number_input(
+                    "并发请求数", min_value=1, max_value=16, value=config.LLM_MAX_WORKERS,
+                    help="分段提取 Word 知识库、分批填写表格时同时发出的 LLM 请求数"
+                )
+                use_response_cache = st.checkbox(
+                    "复用 LLM 缓存结果", value=True,
+                    help="相同的请求直接返回上次的回复；需要重新生成时请取消勾选"
+                )
+                if run_mode == "ollama":
+                    st.caption("提示：Ollama 需设置环境变量 OLLAMA_NUM_PARALLEL 才会并行处理多个请求")
+                st.form_submit_button("应用配置", use_container_width=True)
         
         st.divider()
         local_ip = get_local_ip()
@@ -275,13 +559,7 @@ def main():
             """)
 
     # --- 主体区域 ---
-    st.title("智能填表助手")
-    st.markdown("""
-    <div class='description-text'>
-        基于大语言模型的自动化文档填充工具，支持 Word/Excel 智能数据提取与回填<br>
-        让 AI 帮你完成繁琐的表格填写工作
-    </div>
-    """, unsafe_allow_html=True)
+    render_header()
     
     render_step_indicator(st.session_state.current_step)
 
@@ -333,21 +611,34 @@ def main():
                         st.session_state.current_step = 1
                         st.rerun()
                 
+                # 重新上传会删除或覆盖知识库文件，后台任务读取完成前不允许替换
+                pipeline = st.session_state.pipeline
+                kb_in_use = pipeline is not None and not pipeline["future"].done()
+
                 with col_next:
                     # 检查是否已有文件
                     has_file = uploaded_kb is not None
-                    if st.button("下一步 ➡️", type="primary", disabled=not has_file, use_container_width=True):
+                    if st.button("下一步 ➡️", type="primary", disabled=not has_file or kb_in_use, use_container_width=True):
                         if uploaded_kb:
-                            # 保存文件内容到 session state
+                            # 知识库写入会话临时目录，session state 中只保存路径
+                            kb_path = os.path.join(get_session_dir(), uploaded_kb.name)
+                            # 重新上传时删除上一个知识库文件，会话目录中只保留一份
+                            old_kb = st.session_state.kb_file_data
+                            if old_kb and old_kb["path"] != kb_path and os.path.exists(old_kb["path"]):
+                                os.remove(old_kb["path"])
+                            save_uploaded_file(uploaded_kb, kb_path)
                             st.session_state.kb_file_data = {
                                 "name": uploaded_kb.name,
-                                "data": uploaded_kb.getvalue(),
+                                "path": kb_path,
+                                "digest": file_digest(uploaded_kb),
                                 "type": "docx" if st.session_state.kb_source_type == "从 Word 文档提取" else "xlsx"
                             }
                             st.session_state.current_step = 3
                             st.rerun()
                 
-                if not uploaded_kb and st.session_state.kb_file_data:
+                if kb_in_use:
+                    st.warning("⏳ 后台任务正在使用当前知识库，处理完成后才能更换")
+                elif not uploaded_kb and st.session_state.kb_file_data:
                     st.info(f"✅ 已缓存文件: {st.session_state.kb_file_data['name']}")
 
     # === STEP 3: 上传模板并运行 ===
@@ -357,6 +648,8 @@ def main():
                 st.subheader("步骤 3: 上传模板并生成")
                 
                 # 显示已就绪的知识库
+                if st.session_state.kb_file_data and not os.path.exists(st.session_state.kb_file_data["path"]):
+                    st.session_state.kb_file_data = None
                 if st.session_state.kb_file_data:
                     st.success(f"✅ 知识库已就绪: {st.session_state.kb_file_data['name']}")
                 else:
@@ -364,109 +657,106 @@ def main():
 
                 uploaded_template = st.file_uploader("📤 上传 Word (.docx) 模板文件", type=["docx"])
                 
+                # 后台任务状态：完成后取回结果，进行中则显示当前阶段并稍后刷新
+                pipeline = st.session_state.pipeline
+                if pipeline and pipeline["future"].done():
+                    result = pipeline["future"].result()
+                    st.session_state.pipeline = pipeline = None
+                    st.session_state.run_result = result
+                    if result["file"]:
+                        st.session_state.processed_file = result["file"]
+                running = pipeline is not None
+
                 st.markdown("<br>", unsafe_allow_html=True)
                 col_back, col_run = st.columns([1, 4])
                 
                 with col_back:
-                    if st.button("⬅️ 上一步", use_container_width=True):
+                    # 后台任务仍在读取知识库文件，处理完成前不允许返回上一步重新上传
+                    if st.button("⬅️ 上一步", disabled=running, use_container_width=True):
                         st.session_state.current_step = 2
                         st.rerun()
-                
+
                 with col_run:
-                    run_disabled = uploaded_template is None or st.session_state.kb_file_data is None
+                    run_disabled = running or uploaded_template is None or st.session_state.kb_file_data is None
                     if st.button("🚀 开始处理", type="primary", disabled=run_disabled, use_container_width=True):
-                        # 执行处理逻辑
-                        with st.spinner("正在初始化环境..."):
-                            try:
-                                with tempfile.TemporaryDirectory() as temp_dir:
-                                    # 1. 恢复知识库文件
-                                    kb_info = st.session_state.kb_file_data
-                                    kb_path = os.path.join(temp_dir, kb_info["name"])
-                                    with open(kb_path, "wb") as f:
-                                        f.write(kb_info["data"])
-                                    
-                                    # 2. 保存模板文件
-                                    temp_word_path = os.path.join(temp_dir, uploaded_template.name)
-                                    with open(temp_word_path, "wb") as f:
-                                        f.write(uploaded_template.getbuffer())
-
-                                    # 3. 初始化 LLM
-                                    if run_mode == "api":
-                                        client = APIClient(api_base_url, api_key, api_model)
-                                    else:
-                                        client = OllamaClient(ollama_host, ollama_model)
-
-                                    # 4. 如果是 Word 知识库，先提取
-                                    final_kb_path = kb_path
-                                    if kb_info["type"] == "docx":
-                                        json_kb_path = os.path.join(temp_dir, "extracted.json")
-                                        with st.status("🔍 正在分析文档内容...", expanded=True) as status:
-                                            extract_success = extract_content_to_json(kb_path, json_kb_path, client)
-                                            if not extract_success:
-                                                status.update(label="❌ 提取失败", state="error")
-                                                st.error("知识库提取失败")
-                                                st.stop()
-                                            final_kb_path = json_kb_path
-                                            
-                                            # 实时显示提取的 JSON 数据
-                                            try:
-                                                with open(final_kb_path, "r", encoding="utf-8") as f:
-                                                    json_data = json.load(f)
-                                                    st.markdown("### 📄 提取到的数据")
-                                                    st.json(json_data, expanded=False)
-                                            except Exception as e:
-                                                st.warning(f"无法显示中间数据: {e}")
-
-                                    # 5. 运行 AutoTable
-                                    temp_output_dir = os.path.join(temp_dir, "output")
-                                    with st.status("🤖 正在智能填表...", expanded=True) as status:
-                                        at = AutoTable(final_kb_path, temp_word_path, client, temp_output_dir)
-                                        if at.run():
-                                            status.update(label="✅ 完成！", state="complete")
-                                            # 处理结果
-                                            generated_files = [f for f in os.listdir(temp_output_dir) if f.endswith(".docx")]
-                                            if generated_files:
-                                                result_file = generated_files[0]
-                                                result_path = os.path.join(temp_output_dir, result_file)
-                                                save_to_history(result_path, result_file)
-                                                with open(result_path, "rb") as f:
-                                                    st.session_state.processed_file = (result_file, f.read())
-                                            else:
-                                                st.error("未生成文件")
-                                        else:
-                                            status.update(label="❌ 失败", state="error")
-                                            st.error("填表过程出错")
-                                            
-                            except Exception as e:
-                                st.error(f"发生错误: {str(e)}")
+                        try:
+                            # 本次任务的工作目录（存放提取结果），由后台任务结束后清理
+                            work_dir = tempfile.mkdtemp(dir=get_session_dir(), prefix="run_")
+                            # 模板已在内存中，直接把上传的文件对象（本身就是 BytesIO，带 name）交给后台任务，不写盘也不复制。
+                            # 每次重跑 file_uploader 都会返回新的 UploadedFile，这个对象之后只由后台任务读取，不会被页面脚本移动读写位置
+                            template_file = uploaded_template
+                            template_file.seek(0)
+
+                            # 初始化 LLM（按配置复用已创建的客户端）
+                            if run_mode == "api":
+                                client = get_llm_client("api", api_base_url, api_key, api_model, use_response_cache)
+                            else:
+                                client = get_llm_client("ollama", ollama_host, None, ollama_model, use_response_cache)
+
+                            progress = {"stage": "⏳ 正在初始化环境..."}
+                            future = get_pipeline_executor().submit(
+                                run_pipeline, st.session_state.kb_file_data, template_file, work_dir,
+                                client, max_workers, progress, use_response_cache
+                            )
+                            st.session_state.pipeline = {"future": future, "progress": progress}
+                            st.session_state.run_result = None
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"发生错误: {str(e)}")
+
+                if running:
+                    st.status(pipeline["progress"]["stage"], state="running", expanded=False)
+                elif st.session_state.run_result:
+                    result = st.session_state.run_result
+                    if result["error"]:
+                        st.error(result["error"])
+                    if result["cache_hit"]:
+                        st.caption("♻️ 命中提取缓存，已跳过 LLM 分析")
+                    if result["extracted"] is not None:
+                        with st.expander("📄 提取到的数据", expanded=False):
+                            st.json(result["extracted"], expanded=False)
 
-            
             # 显示下载区域 (仅在 Step 3 显示)
             if st.session_state.processed_file:
-                with st.container(border=True):
-                    st.success("✅ 文档生成成功！")
-                    fname, data = st.session_state.processed_file
-                    st.download_button(
-                        label=f"⬇️ 下载结果: {fname}",
-                        data=data,
-                        file_name=fname,
-                        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                        type="primary",
-                        use_container_width=True
-                    )
+                fname, fpath = st.session_state.processed_file
+                if not os.path.exists(fpath):
+                    # 结果文件已被历史记录清理，释放会话状态
+                    st.session_state.processed_file = None
+                    st.warning("结果文件已从历史记录中清理，请重新生成")
+                else:
+                    with st.container(border=True):
+                        st.success("✅ 文档生成成功！")
+                        st.download_button(
+                            label=f"⬇️ 下载结果: {fname}",
+                            data=functools.partial(read_file_bytes, fpath),
+                            file_name=fname,
+                            mime=DOCX_MIME,
+                            type="primary",
+                            use_container_width=True
+                        )
 
     # --- 底部历史记录 (始终显示) ---
     st.markdown("---")
     with st.expander("📜 历史生成记录", expanded=False):
-        history_dir = "history"
-        if os.path.exists(history_dir):
-            files = [f for f in os.listdir(history_dir) if f.endswith(".docx")]
-            files.sort(key=lambda x: os.path.getmtime(os.path.join(history_dir, x)), reverse=True)
-            for f in files:
-                col1, col2 = st.columns([4, 1])
-                col1.text(f"📄 {f}")
-                with open(os.path.join(history_dir, f), "rb") as file:
-                    col2.download_button("下载", file, file_name=f, key=f"hist_{f}")
+        history_dir = HISTORY_DIR
+        files = list_history(history_dir)
+        for f in files:
+            col1, col2 = st.columns([4, 1])
+            col1.text(f"📄 {f}")
+            # 传入可调用对象，仅在用户点击下载时才读取文件
+            col2.download_button(
+                "下载",
+                data=functools.partial(read_file_bytes, os.path.join(history_dir, f)),
+                file_name=f,
+                mime=DOCX_MIME,
+                key=f"hist_{f}"
+            )
+
+    # 后台任务进行中：整页渲染完成后再等待并刷新，以显示最新进度
+    pipeline = st.session_state.pipeline
+    if pipeline and st.session_state.current_step == 3:
+        time.sleep(PIPELINE_POLL_INTERVAL)
+        st.rerun()
 
 if __name__ == "__main__":
     main()
@@ -1,26 +1,142 @@
 import os
-import pandas as pd
 import logging
+from openpyxl import load_workbook
 from docx import Document
 from docx.oxml.ns import qn
-from docx.shared import Pt, RGBColor
+from docx.table import _Cell
+from docx.shared import Pt, Emu, RGBColor
+from docx.enum.text import WD_UNDERLINE
 import json
+import hashlib
+import orjson
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import re
 
 logger = logging.getLogger(__name__)
 
+# 预编译正则，避免在逐单元格/逐段落的热路径上反复查找编译缓存
+# 填空位识别（_is_potential_slot）
+_SLOT_HEADER_NEG_RE = re.compile(r'^第\s*[（(]\s*[）)]\s*(?:完成人|作者|完成单位|单位|起草人)')
+_SLOT_PAREN_RE = re.compile(r'[(\uff08](?:\s*|.*?(?:填写|输入|粘贴|限|字|内容).*?)[)\uff09]')
+# 不含提示关键词时 _SLOT_PAREN_RE 只可能匹配空括号，改用不回溯的简单正则
+_SLOT_EMPTY_PAREN_RE = re.compile(r'[(\uff08]\s*[)\uff09]')
+_SLOT_PROMPT_KEYWORDS = ("填写", "输入", "粘贴", "限", "字", "内容")
+_LEADING_DIGIT_RE = re.compile(r'^\d')
+_DATE_BLANK_RE = re.compile(r'[_]+|\s+')
+_SLOT_COLON_END_RE = re.compile(r'[:：]\s*$')
+_SLOT_NUMBERED_RE = re.compile(r'^\d+[.、\s]')
+# 清理不可见字符：删除零宽空格，全角空格转为半角空格（一次 translate 完成）
+_SLOT_CLEAN_TABLE = str.maketrans({'\u200b': None, '\u3000': ' '})
+# 填充阶段
+_WS_RE = re.compile(r'\s+')
+_INSTR_HEADER_RE = re.compile(r'^\d+(\.\d+)*[、. ]')
+_CHAR_LIMIT_RE = re.compile(r'[（(].*?不超过.*?字.*?[)）]')
+_LABEL_PREFIX_RE = re.compile(r'^([^:：]{1,10}[:：])')
+_ANCHOR_RE = re.compile(r'\{\{ID_\d+\}\}')
+
+def _dumps(obj):
+    """
+    序列化为 JSON 字符串（orjson，C 实现，比标准库 json 快数倍），非 ASCII 字符原样输出。
+    日期时间等无法直接序列化的值仍交给 str() 处理，与原先 json.dumps(default=str) 的输出一致。
+    """
+    return orjson.dumps(
+        obj, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    ).decode("utf-8")
+
+_JSON_DECODER = json.JSONDecoder()
+
+def _scan_json_item(buf, pos):
+    """
+    从 pos 处解析 JSON 对象中的下一个完整键值对，返回 (key, value, 结束位置)。
+    内容尚不完整（或不是合法 JSON）时返回 None，等待更多数据。
+    """
+    length = len(buf)
+    while pos < length and buf[pos] in " \t\r\n,":
+        pos += 1
+    if pos >= length or buf[pos] != '"':
+        return None
+    try:
+        key, pos = _JSON_DECODER.raw_decode(buf, pos)
+        while pos < length and buf[pos] in " \t\r\n":
+            pos += 1
+        if pos >= length or buf[pos] != ":":
+            return None
+        pos += 1
+        while pos < length and buf[pos] in " \t\r\n":
+            pos += 1
+        value, end = _JSON_DECODER.raw_decode(buf, pos)
+    except ValueError:
+        return None
+    # 值后面必须已经出现逗号或右括号，数字等值才能确认没有被截断（如 3 后面可能还有 .5）
+    while end < length and buf[end] in " \t\r\n":
+        end += 1
+    if end >= length or buf[end] not in ",}":
+        return None
+    return key, value, end
+
+def _iter_json_items(chunks):
+    """
+    增量解析流式返回的 JSON 对象，每个顶层键值对一接收完整就立即产出 (key, value)。
+    只在新片段可能结束一个值（含引号、逗号或右括号）时才尝试解析，避免长字符串值被反复扫描。
+    """
+    buf = ""
+    pos = None # 下一个键值对的起始位置；None 表示尚未遇到对象的左括号
+    for chunk in chunks:
+        buf += chunk
+        if pos is None:
+            start = buf.find("{")
+            if start < 0:
+                continue
+            pos = start + 1
+        elif not any(c in chunk for c in '",}'):
+            continue
+        while True:
+            item = _scan_json_item(buf, pos)
+            if item is None:
+                break
+            key, value, pos = item
+            yield key, value
+
+# 多个表格合并为一次 LLM 请求时，单批表格内容（Markdown + 锚点原文）的字符数上限
+TABLE_BATCH_MAX_CHARS = 12000
+
+# 字符集判断统一用 str.strip（C 实现）：strip 后为空即表示全部字符都在集合内
+_SLOT_CHARS = " _()（）"
+_BLANK_CHARS = " \t\u3000\u00A0"
+_PLACEHOLDER_CHARS = " _\t\u3000\u00A0"
+
+# 样式读写用到的 OOXML 限定标签名，模块加载时一次性生成
+_QN_RPR = qn('w:rPr')
+_QN_RFONTS = qn('w:rFonts')
+_QN_EASTASIA = qn('w:eastAsia')
+_QN_ASCII = qn('w:ascii')
+_QN_SZ = qn('w:sz')
+_QN_B = qn('w:b')
+_QN_COLOR = qn('w:color')
+_QN_I = qn('w:i')
+# 设置字体时同时写入的西文/中文字体属性
+_QN_FONT_ATTRS = (_QN_ASCII, qn('w:hAnsi'), _QN_EASTASIA)
+
 class AutoTable:
     """自动化填表处理核心类"""
-    def __init__(self, knowledge_base_path, word_template_path, llm_client, output_folder="output"):
+    def __init__(self, knowledge_base_path, word_template_path, llm_client, output_folder="output", max_workers=1):
         self.knowledge_base_path = knowledge_base_path
+        # 模板可以是文件路径，也可以是带 name 属性的文件对象（如上传的文件），无需先落盘
         self.word_template_path = word_template_path
+        self.template_name = getattr(word_template_path, "name", word_template_path)
         self.output_folder = output_folder
         self.llm_client = llm_client
+        # 多批表格同时发出的 LLM 请求数；为 1 时逐批顺序请求，后一批可以看到前一批已使用的实体
+        self.max_workers = max_workers
         self.knowledge_base = None
         self.knowledge_dict = None
+        self._kb_json = None # 知识库序列化结果缓存，知识库加载后在整个填表过程中不变
+        self._system_prompt_cache = None # (知识库对象, system 消息)
+        self._llm_cache = {} # 本次运行内的表格分析结果缓存 {请求摘要: 解析后的填充映射}
         self.doc = None
+        self.output_path = None
 
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
@@ -29,40 +145,58 @@ class AutoTable:
         try:
             logger.info(f"正在加载知识库: {self.knowledge_base_path}")
             if self.knowledge_base_path.endswith('.xlsx'):
-                # 读取所有工作表，不将第一行作为表头（header=None）
+                # 读取所有工作表，不将第一行作为表头
                 # 这样可以处理 Key-Value 型的表格，也可以避免错误列名的问题
-                dfs = pd.read_excel(self.knowledge_base_path, sheet_name=None, header=None)
+                # 只读模式逐行流式读取单元格值，直接得到二维列表，无需经过 DataFrame
+                wb = load_workbook(self.knowledge_base_path, read_only=True, data_only=True)
                 
                 # 构建结构化知识库：{ "Sheet名": [ [行1数据], [行2数据], ... ], ... }
                 structured_data = {}
                 total_records = 0
                 
-                for sheet_name, df in dfs.items():
-                    # 处理 NaN 值为 None/空字符串
-                    df = df.where(pd.notnull(df), "")
-                    
-                    # 转换为二维列表 (List of Lists)
-                    # 这种格式最通用，既适合列表型表格，也适合 KV 型表格
-                    # LLM 可以根据数据分布自行推断行列关系
-                    matrix_data = df.values.tolist()
-                    
-                    # 特殊处理 Text_Content: 如果它是原来的格式（有 Header），pd.read_excel(header=None) 会把 Header 也读成第一行数据
-                    # 但 Text_Content 比较简单，即使把 'Content', 'Type' 当作数据也不影响理解
-                    
-                    structured_data[sheet_name] = matrix_data
-                    total_records += len(matrix_data)
+                try:
+                    for ws in wb.worksheets:
+                        # 转换为二维列表 (List of Lists)，空单元格处理为空字符串
+                        # 这种格式最通用，既适合列表型表格，也适合 KV 型表格
+                        # LLM 可以根据数据分布自行推断行列关系
+                        matrix_data = []
+                        for row in ws.iter_rows(values_only=True):
+                            values = ["" if v is None else v for v in row]
+                            # 去掉行尾空单元格，稍后统一补齐
+                            while values and values[-1] == "":
+                                values.pop()
+                            matrix_data.append(values)
+                        
+                        # 去掉表尾空行，并补齐为矩形矩阵（与原先按表格区域读取的结果一致）
+                        while matrix_data and not matrix_data[-1]:
+                            matrix_data.pop()
+                        width = max((len(values) for values in matrix_data), default=0)
+                        for values in matrix_data:
+                            values.extend([""] * (width - len(values)))
+                        
+                        # 特殊处理 Text_Content: 如果它是原来的格式（有 Header），表头也会被读成第一行数据
+                        # 但 Text_Content 比较简单，即使把 'Content', 'Type' 当作数据也不影响理解
+                        
+                        structured_data[ws.title] = matrix_data
+                        total_records += len(matrix_data)
+                finally:
+                    wb.close()
                 
                 self.knowledge_dict = structured_data
-                logger.info(f"Excel知识库加载完成，共读取 {len(dfs)} 个工作表，合计 {total_records} 条数据")
+                self._kb_json = None
+                logger.info(f"Excel知识库加载完成，共读取 {len(structured_data)} 个工作表，合计 {total_records} 条数据")
                 
-                # 输出结构化后的字典供调试/查看
-                logger.info(f"结构化处理后的知识库字典: {json.dumps(self.knowledge_dict, ensure_ascii=False, default=str)}")
+                # 输出结构化后的字典供调试/查看；知识库可能很大，仅在开启 DEBUG 日志时输出
+                # （序列化结果会被缓存，后续构造 Prompt 时直接复用）
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("结构化处理后的知识库字典: %s", self._knowledge_json(self.knowledge_dict))
                 
                 return True
             elif self.knowledge_base_path.endswith('.json'):
                 # 直接读取 JSON 格式的知识库
-                with open(self.knowledge_base_path, 'r', encoding='utf-8') as f:
-                    self.knowledge_dict = json.load(f)
+                with open(self.knowledge_base_path, 'rb') as f:
+                    self.knowledge_dict = orjson.loads(f.read())
+                self._kb_json = None
                 logger.info(f"JSON知识库加载完成: {self.knowledge_base_path}")
                 return True
             else:
@@ -74,7 +208,7 @@ class AutoTable:
 
     def load_template(self):
         try:
-            logger.info(f"正在加载Word模板: {self.word_template_path}")
+            logger.info(f"正在加载Word模板: {self.template_name}")
             self.doc = Document(self.word_template_path)
             logger.info(f"模板加载完成，包含{len(self.doc.tables)}个表格")
             return True
@@ -92,40 +226,47 @@ class AutoTable:
             return True
             
         # 移除常见的不可见字符和空白
-        clean_text = text.strip().replace('\u200b', '').replace('\u3000', ' ')
+        clean_text = text.strip().translate(_SLOT_CLEAN_TABLE)
         if not clean_text:
             return True
             
         # 负向规则：排除明显的表头/Label（防止误判）
         # 1. "第( )完成人"、"第( )完成单位" 类型的表头
-        if re.match(r'^第\s*[（(]\s*[）)]\s*(?:完成人|作者|完成单位|单位|起草人)', clean_text):
+        # 各规则先做廉价的字符检查（in / startswith 为 C 实现），只有可能命中时才执行正则
+        if clean_text[0] == '第' and _SLOT_HEADER_NEG_RE.match(clean_text):
             return False
             
-        if set(clean_text).issubset(set(" _()（）")):
+        if not clean_text.strip(_SLOT_CHARS):
             return True
         
         # 正则增强规则
         # 包含连续下划线
-        if re.search(r'[_]{2,}', clean_text):
+        if '__' in clean_text:
             return True
         # 包含空括号 或 提示性括号
-        elif re.search(r'[(\uff08](?:\s*|.*?(?:填写|输入|粘贴|限|字|内容).*?)[)\uff09]', clean_text):
+        elif ('(' in clean_text or '\uff08' in clean_text) and self._has_slot_paren(clean_text):
             return True
         # 包含 "年" 和 "月" 的日期格式
         elif '年' in clean_text and '月' in clean_text:
-            if not re.match(r'^\d', clean_text):
-                 if re.search(r'[_]+|\s+', clean_text):
+            if not _LEADING_DIGIT_RE.match(clean_text):
+                 if _DATE_BLANK_RE.search(clean_text):
                      return True
         # 启发式规则：以冒号结尾的 Prompt
-        elif re.search(r'[:：]\s*$', clean_text):
+        elif (':' in clean_text or '：' in clean_text) and _SLOT_COLON_END_RE.search(clean_text):
             return True
         # 针对大表格的长文本Prompt（如 "1. 成果简介..."）
         # 特征：以数字序号开头，且长度超过一定阈值，暗示这是一个问题描述而非简单标题
-        elif re.match(r'^\d+[.、\s]', clean_text) and len(clean_text) > 5:
+        elif len(clean_text) > 5 and clean_text[0].isdigit() and _SLOT_NUMBERED_RE.match(clean_text):
             return True
             
         return False
 
+    def _has_slot_paren(self, clean_text):
+        """是否包含空括号或提示性括号（如“（请填写）”）：先做关键词字面检查，只有包含关键词时才执行带回溯的完整正则"""
+        if any(keyword in clean_text for keyword in _SLOT_PROMPT_KEYWORDS):
+            return _SLOT_PAREN_RE.search(clean_text) is not None
+        return _SLOT_EMPTY_PAREN_RE.search(clean_text) is not None
+
     def _has_visual_placeholder(self, element):
         """
         检查段落或单元格是否包含“视觉占位符”（带下划线的空白区域）。
@@ -138,13 +279,15 @@ class AutoTable:
             
         for para in paragraphs:
             for run in para.runs:
-                # 检查是否有下划线
-                is_underlined = run.underline is not None and run.underline is not False
-                # 检查内容是否主要为空白
+                # 先做最便宜的判断：绝大多数 Run 没有下划线，直接跳过，无需读取文本
+                underline = run.underline
+                if underline is None or underline is False:
+                    continue
                 text = run.text
-                is_blank = all(c in ' \t\u3000\u00A0' for c in text)
-                
-                if is_underlined and is_blank and len(text) >= 2:
+                if len(text) < 2:
+                    continue
+                # 检查内容是否全部为空白
+                if not text.strip(_BLANK_CHARS):
                     return True
         return False
 
@@ -162,14 +305,17 @@ class AutoTable:
         for idx, para in enumerate(paragraphs):
             text = para.text.strip()
             
-            # 检查是否包含视觉占位符（如下划线空格）
-            has_visual_slot = self._has_visual_placeholder(para)
-            
-            # 修复：跳过空段落，除非它包含视觉占位符
-            if not text and not has_visual_slot:
+            # 检查是否包含视觉占位符（如下划线空格）：需要遍历所有 Run，
+            # 仅在文本规则无法判定时才检查
+            if text:
+                is_slot = self._is_potential_slot(text) or self._has_visual_placeholder(para)
+            elif self._has_visual_placeholder(para):
+                is_slot = True
+            else:
+                # 修复：跳过空段落，除非它包含视觉占位符
                 continue
                 
-            if self._is_potential_slot(text) or has_visual_slot:
+            if is_slot:
                 anchor_id = f"{{{{ID_{anchor_counter:03d}}}}}"
                 anchor_map[anchor_id] = idx
                 id_to_text_map[anchor_id] = f"原内容: '{text}'"
@@ -190,6 +336,30 @@ class AutoTable:
         markdown_text = "\n".join(markdown_lines)
         return markdown_text, anchor_map, id_to_text_map
 
+    def _table_cell_grid(self, table):
+        """
+        一次遍历表格 XML（tr/tc），返回每行的单元格列表，语义与 row.cells 一致：
+        横向合并（gridSpan）的单元格按跨度重复出现，纵向合并的续行单元格指向起始单元格。
+        避免 table.rows / row.cells 反复构造包装对象，以及 table.cell() 每次调用都重建整表单元格数组。
+        """
+        grid = []
+        above = {} # 上一行 {网格起始列: 单元格}，用于解析纵向合并
+        for tr in table._tbl.tr_lst:
+            row_cells = []
+            current = {}
+            offset = tr.grid_before
+            for tc in tr.tc_lst:
+                cell = above.get(offset) if tc.vMerge == "continue" else None
+                if cell is None:
+                    cell = _Cell(tc, table)
+                span = tc.grid_span
+                current[offset] = cell
+                row_cells.extend([cell] * span)
+                offset += span
+            grid.append(row_cells)
+            above = current
+        return grid
+
     def _preprocess_table(self, table):
         """
         预处理表格：识别填空位，生成带锚点的Markdown文本，并记录锚点映射。
@@ -200,22 +370,29 @@ class AutoTable:
         markdown_lines = []
         anchor_counter = 1
         
-        # 使用列表存储已处理的单元格 _tc 对象，以处理合并单元格
-        processed_tcs = [] # Store (tc_object, anchor_id)
+        # 使用字典记录已处理的单元格 _tc 对象，以处理合并单元格（O(1) 查找）
+        # 直接以 _tc 元素为键：字典持有引用，lxml 会对同一节点始终返回同一个代理对象
+        processed_tcs = {} # {tc_object: anchor_id}
         
-        # 遍历每一行
-        for row_idx, row in enumerate(table.rows):
+        # 遍历每一行（一次性构建单元格网格，后续邻居查找直接索引）
+        grid = self._table_cell_grid(table)
+        # 预先计算每个单元格的文本矩阵（合并单元格只读取一次），邻居 Label 直接按下标读取
+        text_by_tc = {}
+        for row_cells in grid:
+            for cell in row_cells:
+                if cell._tc not in text_by_tc:
+                    text_by_tc[cell._tc] = cell.text.strip()
+        all_text = [[text_by_tc[cell._tc] for cell in row_cells] for row_cells in grid]
+        slot_by_tc = {}
+
+        for row_idx, row_cells in enumerate(grid):
             row_cells_text = []
-            for col_idx, cell in enumerate(row.cells):
-                cell_text = cell.text.strip()
+            for col_idx, cell in enumerate(row_cells):
+                cell_text = all_text[row_idx][col_idx]
                 
                 # 检查该单元格是否已处理过
                 current_tc = cell._tc
-                existing_anchor_id = None
-                for seen_tc, seen_id in processed_tcs:
-                    if current_tc == seen_tc:
-                        existing_anchor_id = seen_id
-                        break
+                existing_anchor_id = processed_tcs.get(current_tc)
                 
                 if existing_anchor_id:
                     # 如果已处理过，直接使用之前的 ID
@@ -225,32 +402,34 @@ class AutoTable:
                     continue
 
                 # 判断是否是填空位
-                is_potential_slot = self._is_potential_slot(cell_text)
-                has_visual_slot = self._has_visual_placeholder(cell)
+                # 结果按 _tc 缓存：跨列/跨行合并的非填空单元格在网格中重复出现，无需重复遍历段落和 Run；
+                # 文本已判定为填空位时不再检查下划线占位符
+                is_slot = slot_by_tc.get(current_tc)
+                if is_slot is None:
+                    is_slot = self._is_potential_slot(cell_text) or self._has_visual_placeholder(cell)
+                    slot_by_tc[current_tc] = is_slot
                 
-                if is_potential_slot or has_visual_slot:
+                if is_slot:
                     anchor_id = f"{{{{ID_{anchor_counter:03d}}}}}"
                     anchor_map[anchor_id] = (row_idx, col_idx)
                     
                     # 记录为已处理
-                    processed_tcs.append((current_tc, anchor_id))
+                    processed_tcs[current_tc] = anchor_id
                     
                     # 尝试获取上下文提示（Label）
                     context_hint = ""
-                    try:
-                        # 尝试获取左侧单元格文本作为提示
-                        if col_idx > 0:
-                            left_text = row.cells[col_idx-1].text.strip()
-                            if left_text and len(left_text) < 20:
-                                context_hint = f" | 左侧Label: {left_text}"
-                        
-                        # 如果左侧为空，尝试获取上方单元格文本（针对上下结构的表格）
-                        if not context_hint and row_idx > 0:
-                            top_text = table.cell(row_idx-1, col_idx).text.strip()
-                            if top_text and len(top_text) < 20:
-                                context_hint = f" | 上方Label: {top_text}"
-                    except Exception:
-                        pass
+                    # 尝试获取左侧单元格文本作为提示
+                    if col_idx > 0:
+                        left_text = all_text[row_idx][col_idx-1]
+                        if left_text and len(left_text) < 20:
+                            context_hint = f" | 左侧Label: {left_text}"
+                    
+                    # 如果左侧为空，尝试获取上方单元格文本（针对上下结构的表格）
+                    # 上一行可能较短（行首/行尾缺少单元格），需检查列下标
+                    if not context_hint and row_idx > 0 and col_idx < len(all_text[row_idx-1]):
+                        top_text = all_text[row_idx-1][col_idx]
+                        if top_text and len(top_text) < 20:
+                            context_hint = f" | 上方Label: {top_text}"
 
                     # 记录原始文本和上下文提示，供LLM参考
                     id_to_text_map[anchor_id] = f"原内容: '{cell_text}'{context_hint}"
@@ -271,42 +450,39 @@ class AutoTable:
                     clean_text = cell_text.replace('\n', '<br>')
                     row_cells_text.append(clean_text)
             
-            markdown_lines.append("| " + " | ".join(row_cells_text) + " |")
+            # 每行只做一次 join 并直接格式化，不再经过两次字符串拼接产生中间对象
+            markdown_lines.append(f"| {' | '.join(row_cells_text)} |")
             
         # 组合成Markdown表格字符串
         markdown_text = "\n".join(markdown_lines)
         return markdown_text, anchor_map, id_to_text_map
 
-    def analyze_tables_with_llm(self, table_markdown, knowledge_context, id_to_text_map, used_contexts=None):
+    def _knowledge_json(self, knowledge_context):
+        """序列化知识库；当前知识库的结果只计算一次，避免每个表格都重复序列化整个知识库"""
+        if knowledge_context is not self.knowledge_dict:
+            return _dumps(knowledge_context)
+        if self._kb_json is None:
+            self._kb_json = _dumps(knowledge_context)
+        return self._kb_json
+
+    def _system_prompt(self, knowledge_context):
+        """
+        构造 system 消息（规则 + 知识库）。同一知识库只构造一次并缓存：各次请求的 system 消息逐字节相同，
+        服务端前缀缓存才能命中，也省去每个表格重复拼接整个知识库字符串。
+        """
+        cached = self._system_prompt_cache
+        if cached is not None and cached[0] is knowledge_context:
+            return cached[1]
+
         # 动态判断知识库格式，生成不同的 Prompt 描述
         data_format_desc = "扁平化的 JSON 键值对（Key-Value）" if isinstance(knowledge_context, dict) else "按 Sheet（来源）分组的二维数组（矩阵）格式"
-        
-        used_context_desc = ""
-        if used_contexts and len(used_contexts) > 0:
-            used_context_desc = f"""
-        **上下文去重约束（重要）**：
-        当前文档中包含多个结构相似的表格，用于填写不同实体（人员/项目）的信息。
-        以下实体标识（如姓名、项目名）**已被前面的表格使用过**：
-        {json.dumps(used_contexts, ensure_ascii=False)}
-        
-        **请务必从知识库中选择一个【未使用过】的新实体数据进行填充。**
-        - 如果知识库是人员列表，请选择下一个不同的人员。
-        - 如果知识库是项目列表，请选择下一个不同的项目。
-        - 如果确实没有更多新数据，才允许重复。
-        """
 
-        prompt = f"""
-        请分析以下带有锚点（格式如 {{{{ID_XXX}}}}）的文档内容（表格或段落），并结合提供的知识库数据，将正确的值填入对应的锚点。
-        
-        知识库数据（{data_format_desc}）：
-        {json.dumps(knowledge_context, ensure_ascii=False, default=str)}
-        
-        文档内容结构（Markdown）：
-        {table_markdown}
-        
-        锚点对应的原始文本（参考用，可能包含提示信息）：
-        {json.dumps(id_to_text_map, ensure_ascii=False)}
-        {used_context_desc}
+        # Prompt 按“静态在前、动态在后”组织：规则和知识库在一次运行中对所有表格都相同，放在 system 消息中，
+        # 使各次请求共享尽可能长的相同前缀，便于服务端的前缀缓存（Prompt Caching / KV Cache）命中；
+        # 表格内容、锚点原文和去重约束每次不同，放在 user 消息中
+        system_prompt = f"""
+        你是一个专业的文档填充助手，擅长处理复杂表格和多层级数据映射。
+        用户会提供带有锚点（格式如 {{{{ID_XXX}}}}）的文档内容（表格或段落），请结合下面提供的知识库数据，将正确的值填入对应的锚点。
         
         **核心原则：严格基于知识库**
         1. **绝对禁止编造数据**：你只能使用“知识库数据”中显式提供的信息。
@@ -356,30 +532,147 @@ class AutoTable:
             ...
         }}
         请确保只返回JSON格式数据，不要包含其他内容。
+        
+        知识库数据（{data_format_desc}）：
+        {self._knowledge_json(knowledge_context)}
+        """
+        self._system_prompt_cache = (knowledge_context, system_prompt)
+        return system_prompt
+
+    def analyze_tables_with_llm(self, table_markdown, knowledge_context, id_to_text_map, used_contexts=None, table_count=1, on_item=None, table_offset=0):
+        """
+        请求 LLM 分析带锚点的内容，返回填充映射 {锚点: 值}。
+        传入 on_item 时以流式方式接收回复，每个键值对解析完整后立即回调 on_item(key, value)，
+        调用方可以边生成边写入；返回结果中的每个键都会且只会回调一次。
+        table_offset 为并行请求时前面同结构、但实体尚未计入 used_contexts 的表格数，提示模型跳过相应数量的实体。
+        """
+        # 同一文档中常有结构完全相同的表格，表格内容、锚点原文和已用实体都相同时直接复用上次的结果
+        cache_key = None
+        if knowledge_context is self.knowledge_dict:
+            key_src = orjson.dumps([table_markdown, id_to_text_map, used_contexts or [], table_offset], default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+            cache_key = hashlib.blake2b(key_src, digest_size=16).hexdigest()
+            if cache_key in self._llm_cache:
+                logger.info("表格内容与之前的请求相同，复用分析结果")
+                # 调用方会 pop("__identity__")，返回副本以免修改缓存
+                fill_map = dict(self._llm_cache[cache_key])
+                if on_item:
+                    for key, value in fill_map.items():
+                        on_item(key, value)
+                return fill_map
+
+        used_context_desc = ""
+        if used_contexts and len(used_contexts) > 0:
+            used_context_desc = f"""
+        **上下文去重约束（重要）**：
+        当前文档中包含多个结构相似的表格，用于填写不同实体（人员/项目）的信息。
+        以下实体标识（如姓名、项目名）**已被前面的表格使用过**：
+        {_dumps(used_contexts)}
+        
+        **请务必从知识库中选择一个【未使用过】的新实体数据进行填充。**
+        - 如果知识库是人员列表，请选择下一个不同的人员。
+        - 如果知识库是项目列表，请选择下一个不同的项目。
+        - 如果确实没有更多新数据，才允许重复。
+        """
+
+        system_prompt = self._system_prompt(knowledge_context)
+
+        batch_desc = ""
+        if table_count > 1:
+            batch_desc = f"""
+        **多表格说明**：
+        本次共包含 {table_count} 个表格（以“## 表格N”分隔），锚点带有表格前缀（如 {{{{T1_ID_001}}}}），请为每个锚点分别填写。
+        如果多个表格结构相似、用于填写不同实体（人员/项目），请为每个表格依次选择不同的实体，不要重复。
+        此时 "__identity__" 请返回数组，按表格顺序列出每个表格使用的实体标识。
+        """
+
+        offset_desc = ""
+        if table_offset > 0:
+            offset_desc = f"""
+        **并行填写说明**：
+        文档中排在本表格之前、结构与本表格完全相同的 {table_offset} 个表格正由其他请求同时填写，它们使用的实体未列入上面的已使用列表。
+        请按知识库中的顺序，跳过符合条件的未使用实体中的前 {table_offset} 个，从第 {table_offset + 1} 个开始选择。
+        """
+
+        prompt = f"""
+        请分析以下带有锚点的文档内容，按照要求返回填充结果。
+        
+        文档内容结构（Markdown）：
+        {table_markdown}
+        
+        锚点对应的原始文本（参考用，可能包含提示信息）：
+        {_dumps(id_to_text_map)}
+        {used_context_desc}{batch_desc}{offset_desc}
+        请确保只返回JSON格式数据，不要包含其他内容。
         """
         try:
             messages = [
-                {"role": "system", "content": "你是一个专业的文档填充助手，擅长处理复杂表格和多层级数据映射。"},
+                {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt}
             ]
-            result = self.llm_client.chat_completion(messages, temperature=0.1)
-            json_str = self._extract_json(result)
-            return json.loads(json_str)
+            if on_item:
+                fill_map = self._stream_fill_map(messages, on_item)
+            else:
+                result = self.llm_client.chat_completion(messages, temperature=0.1)
+                fill_map = self._extract_json(result)
+            if cache_key and fill_map:
+                self._llm_cache[cache_key] = dict(fill_map)
+            return fill_map
         except Exception as e:
             logger.error(f"表格分析失败: {str(e)}")
             return {}
 
-    def _extract_json(self, text):
+    def _stream_fill_map(self, messages, on_item):
+        """流式请求并增量解析填充映射，每解析出一个键值对就回调 on_item"""
+        parts = []
+        fill_map = {}
+
+        def _chunks():
+            stream_fn = getattr(self.llm_client, "chat_completion_stream", None)
+            if stream_fn is None:
+                # 未继承 BaseLLMClient 的客户端不支持流式，一次性取回完整回复
+                stream = [self.llm_client.chat_completion(messages, temperature=0.1)]
+            else:
+                stream = stream_fn(messages, temperature=0.1)
+            for chunk in stream:
+                parts.append(chunk)
+                yield chunk
+
         try:
-            json.loads(text)
-            return text
-        except json.JSONDecodeError:
-            import re
-            # 移除 replace('\n', '') 以保留 JSON 字符串中的换行符
-            json_match = re.search(r'({.*})', text, re.DOTALL)
-            if json_match:
-                return json_match.group(1)
+            for key, value in _iter_json_items(_chunks()):
+                fill_map[key] = value
+                on_item(key, value)
+        except Exception as e:
+            if not fill_map:
+                raise
+            # 部分结果已经写入文档，不能再整体重试，保留已收到的内容
+            logger.warning(f"流式接收中断，保留已解析的 {len(fill_map)} 项: {str(e)}")
+            return fill_map
+
+        # 兜底：回复不是单纯的 JSON 对象（如带有说明文字或代码块）时，用完整文本再解析一次，补上遗漏的项
+        try:
+            parsed = self._extract_json("".join(parts))
+        except ValueError:
+            if not fill_map:
+                raise
+            parsed = {}
+        if isinstance(parsed, dict):
+            for key, value in parsed.items():
+                if key not in fill_map:
+                    fill_map[key] = value
+                    on_item(key, value)
+        return fill_map
+
+    def _extract_json(self, text):
+        """
+        解析 LLM 回复中的 JSON 对象并返回解析结果。
+        回复常带有说明文字或代码块标记，直接截取第一个 { 到最后一个 } 之间的内容解析
+        （两次 C 实现的查找，不再先整体解析失败、再用 DOTALL 正则回溯匹配）。
+        """
+        start = text.find('{')
+        end = text.rfind('}')
+        if start == -1 or end < start:
             raise ValueError("未找到有效JSON内容")
+        return orjson.loads(text[start:end + 1])
 
     def _extract_paragraph_char_style(self, paragraph):
         """从段落属性(pPr)中提取默认字符样式"""
@@ -393,22 +686,22 @@ class AutoTable:
             # 安全获取 rPr (Run Properties)
             # 注意：pPr 是一个 CT_PPr 对象，它可能没有直接的 .rPr 属性访问器
             # 我们应该使用 find 方法来查找子元素
-            rPr = p.pPr.find(qn('w:rPr'))
+            rPr = p.pPr.find(_QN_RPR)
             
             if rPr is None:
                 return style
             
             # 1. 字体名称
             # rPr.rFonts 可能也是通过 find 获取
-            rFonts = rPr.find(qn('w:rFonts'))
+            rFonts = rPr.find(_QN_RFONTS)
             if rFonts is not None:
                 # 优先取中文字体(eastAsia)，其次 ascii
-                font_name = rFonts.get(qn('w:eastAsia')) or rFonts.get(qn('w:ascii'))
+                font_name = rFonts.get(_QN_EASTASIA) or rFonts.get(_QN_ASCII)
                 if font_name:
                     style['name'] = font_name
             
             # 2. 字号 (XML中是半点，1/144英寸)
-            sz = rPr.find(qn('w:sz'))
+            sz = rPr.find(_QN_SZ)
             if sz is not None and sz.val is not None:
                 try:
                     # Pt(1) = 2 half-points
@@ -426,14 +719,14 @@ class AutoTable:
                     pass
 
             # 3. 加粗
-            b = rPr.find(qn('w:b'))
+            b = rPr.find(_QN_B)
             if b is not None:
                 # 标签存在即为真，除非显式设为 false/0
                 val = b.val
                 style['bold'] = False if val in ['0', 'false', 'off'] else True
             
             # 4. 颜色
-            color = rPr.find(qn('w:color'))
+            color = rPr.find(_QN_COLOR)
             if color is not None and color.val is not None:
                 hex_color = color.val
                 if hex_color != 'auto':
@@ -443,7 +736,7 @@ class AutoTable:
                         pass
                         
             # 5. 斜体
-            i = rPr.find(qn('w:i'))
+            i = rPr.find(_QN_I)
             if i is not None:
                  val = i.val
                  style['italic'] = False if val in ['0', 'false', 'off'] else True
@@ -481,30 +774,34 @@ class AutoTable:
         return style
 
     def _apply_run_style(self, run, style):
-        """应用字体样式到Run"""
+        """
+        应用字体样式到Run
+        只获取一次 rPr，直接写入各属性元素，不经过 run.font 的属性包装（每次访问都会重新查找/创建 rPr）。
+        子元素通过 get_or_add_* 创建，保证符合 OOXML 规定的元素顺序。
+        """
         if not style:
             return
-            
+        
+        rPr = run._element.get_or_add_rPr()
+        
         if 'name' in style:
-            run.font.name = style['name']
-            # 设置中文字体
-            try:
-                rPr = run._element.get_or_add_rPr()
-                rFonts = rPr.get_or_add_rFonts()
-                rFonts.set(qn('w:eastAsia'), style['name'])
-            except Exception as e:
-                logger.warning(f"设置中文字体失败: {e}")
+            # 西文字体和中文字体（eastAsia）一次写入
+            rFonts = rPr.get_or_add_rFonts()
+            for attr in _QN_FONT_ATTRS:
+                rFonts.set(attr, style['name'])
             
         if 'size' in style:
-            run.font.size = style['size']
+            rPr.get_or_add_sz().val = Emu(style['size'])
         if 'bold' in style:
-            run.font.bold = style['bold']
+            rPr.get_or_add_b().val = bool(style['bold'])
         if 'italic' in style:
-            run.font.italic = style['italic']
+            rPr.get_or_add_i().val = bool(style['italic'])
         if 'color' in style:
-            run.font.color.rgb = style['color']
+            rPr._remove_color()
+            rPr.get_or_add_color().val = style['color']
         if 'underline' in style:
-            run.font.underline = style['underline']
+            underline = style['underline']
+            rPr.u_val = WD_UNDERLINE.SINGLE if underline is True else underline
 
     def _smart_fill_paragraph(self, para, value):
         """
@@ -519,7 +816,7 @@ class AutoTable:
         for i, run in enumerate(runs):
             text = run.text
             is_underlined = run.underline is not None and run.underline is not False
-            is_placeholder_chars = all(c in ' _\t\u3000\u00A0' for c in text)
+            is_placeholder_chars = not text.strip(_PLACEHOLDER_CHARS)
             
             # 必须有一定的长度（避免误判单个空格），或者是纯下划线
             if is_underlined and (len(text) >= 1 and is_placeholder_chars):
@@ -533,13 +830,12 @@ class AutoTable:
 
         # 2. 提取 Label 和 Value
         # Label 是占位符之前的所有文本
-        label_text = "".join([r.text for r in runs[:placeholder_idx]])
+        label_text = "".join(r.text for r in runs[:placeholder_idx])
         
         # 归一化处理以进行模糊匹配
-        import re
-        label_clean = re.sub(r'\s+', '', label_text)
+        label_clean = _WS_RE.sub('', label_text)
         value_str = str(value)
-        value_clean = re.sub(r'\s+', '', value_str)
+        value_clean = _WS_RE.sub('', value_str)
         
         fill_content = ""
         
@@ -549,26 +845,11 @@ class AutoTable:
         
         # 简单的字符串包含检查
         if label_clean and label_clean in value_clean:
-            # 找到 label 在 value 中的位置
-            # 这比较难精确对应到 value_str 的索引，因为空格差异。
-            # 采用字符逐个匹配法
-            val_ptr = 0
-            lbl_ptr = 0
-            match_end_idx = 0
-            
-            while val_ptr < len(value_str) and lbl_ptr < len(label_clean):
-                if value_str[val_ptr].isspace():
-                    val_ptr += 1
-                    continue
-                
-                if value_str[val_ptr] == label_clean[lbl_ptr]:
-                    val_ptr += 1
-                    lbl_ptr += 1
-                    match_end_idx = val_ptr
-                else:
-                    break
-            
-            if lbl_ptr == len(label_clean):
+            # 去除空白后 value 须以 label 开头；再用 label 各字符之间允许任意空白的正则在原串开头匹配，
+            # m.end() 即 label 最后一个字符之后的位置，只扫描 label 对应的前缀部分
+            if value_clean.startswith(label_clean):
+                label_re = r'\s*' + r'\s*'.join(map(re.escape, label_clean))
+                match_end_idx = re.match(label_re, value_str).end()
                 fill_content = value_str[match_end_idx:].strip()
             else:
                 # 匹配失败，可能 LLM 修改了 Label
@@ -595,7 +876,7 @@ class AutoTable:
         for i in range(placeholder_idx + 1, len(runs)):
             r = runs[i]
             is_underlined = r.underline is not None and r.underline is not False
-            is_placeholder_chars = all(c in ' _\t\u3000\u00A0' for c in r.text)
+            is_placeholder_chars = not r.text.strip(_PLACEHOLDER_CHARS)
             if is_underlined and is_placeholder_chars:
                 r.text = ""
             else:
@@ -604,6 +885,261 @@ class AutoTable:
                 
         return True
 
+    def _pop_identities(self, fill_map):
+        """取出 LLM 返回的实体标识（合并请求时为按表格顺序排列的列表）"""
+        identity = fill_map.pop("__identity__", None)
+        if not identity:
+            return []
+        if isinstance(identity, list):
+            return [item for item in identity if item]
+        return [identity]
+
+    def _batch_tables(self, pending_tables, max_chars=None):
+        """按内容长度将待处理表格分批，每批合并为一次 LLM 请求"""
+        max_chars = TABLE_BATCH_MAX_CHARS if max_chars is None else max_chars
+        batches = []
+        current = []
+        current_size = 0
+        for item in pending_tables:
+            _, _, table_markdown, _, id_to_text_map = item
+            item_size = len(table_markdown) + sum(len(k) + len(v) for k, v in id_to_text_map.items())
+            if current and current_size + item_size > max_chars:
+                batches.append(current)
+                current = []
+                current_size = 0
+            current.append(item)
+            current_size += item_size
+        if current:
+            batches.append(current)
+        return batches
+
+    def _analyze_table_batch(self, batch, used_identities, on_fill=None, table_offset=0):
+        """
+        对一批表格发起一次 LLM 请求，返回 (每个表格的填充映射列表, 本批使用的实体标识列表)。
+        多个表格时锚点加上表格前缀（{{T<n>_ID_001}}）合并为一份文档，返回后再按前缀拆分回各表格。
+        传入 on_fill 时流式接收回复，每个锚点的值一解析出来就回调 on_fill(批内序号, 原锚点, 值)。
+        table_offset 见 analyze_tables_with_llm。
+        """
+        if len(batch) == 1:
+            table_idx, _, table_markdown, _, id_to_text_map = batch[0]
+            on_item = None
+            if on_fill:
+                def on_item(anchor_id, value):
+                    # "__identity__" 等非锚点键由调用方单独处理
+                    if not anchor_id.startswith("__"):
+                        on_fill(0, anchor_id, value)
+            fill_map = self.analyze_tables_with_llm(table_markdown, self.knowledge_dict, id_to_text_map,
+                                                    used_contexts=used_identities, on_item=on_item, table_offset=table_offset)
+            # 提取并记录本次使用的实体标识
+            identities = self._pop_identities(fill_map)
+            if identities:
+                logger.info(f"表格 {table_idx + 1} 使用了实体: {identities[0] if len(identities) == 1 else identities}")
+            return [fill_map], identities
+
+        sections = []
+        merged_id_map = {}
+        anchor_owner = {} # {带前缀的锚点: (批内序号, 原锚点)}
+        for pos, (table_idx, _, table_markdown, _, id_to_text_map) in enumerate(batch):
+            prefix = f"T{table_idx + 1}_"
+            rename = {anchor_id: "{{" + prefix + anchor_id[2:] for anchor_id in id_to_text_map}
+            for anchor_id, global_id in rename.items():
+                merged_id_map[global_id] = id_to_text_map[anchor_id]
+                anchor_owner[global_id] = (pos, anchor_id)
+            renamed = _ANCHOR_RE.sub(lambda m: rename.get(m.group(0), m.group(0)), table_markdown)
+            sections.append(f"## 表格{table_idx + 1}\n{renamed}")
+
+        on_item = None
+        if on_fill:
+            def on_item(anchor_id, value):
+                owner = anchor_owner.get(anchor_id)
+                if owner is not None:
+                    on_fill(owner[0], owner[1], value)
+
+        table_nums = [item[0] + 1 for item in batch]
+        logger.info(f"合并请求表格: {table_nums}")
+        merged = self.analyze_tables_with_llm("\n\n".join(sections), self.knowledge_dict, merged_id_map,
+                                              used_contexts=used_identities, table_count=len(batch), on_item=on_item,
+                                              table_offset=table_offset)
+        identities = self._pop_identities(merged)
+        if not merged:
+            # 合并请求失败（如超出模型上下文或返回格式异常）时回退为逐个表格请求
+            logger.warning("合并请求未返回有效结果，改为逐个表格请求")
+            fill_maps = []
+            identities = []
+            for pos, item in enumerate(batch):
+                item_on_fill = None
+                if on_fill:
+                    item_on_fill = lambda _, anchor_id, value, pos=pos: on_fill(pos, anchor_id, value)
+                item_maps, item_identities = self._analyze_table_batch([item], used_identities + identities, on_fill=item_on_fill,
+                                                                       table_offset=table_offset)
+                fill_maps.extend(item_maps)
+                identities.extend(item_identities)
+            return fill_maps, identities
+
+        if identities:
+            logger.info(f"表格 {table_nums} 使用了实体: {identities}")
+        fill_maps = [{} for _ in batch]
+        for anchor_id, value in merged.items():
+            owner = anchor_owner.get(anchor_id)
+            if owner is None:
+                logger.warning(f"LLM返回了不存在的表格锚点ID: {anchor_id}")
+                continue
+            pos, local_id = owner
+            fill_maps[pos][local_id] = value
+        return fill_maps, identities
+
+    def _fill_table(self, table, anchor_map, fill_map, grid=None):
+        """将 LLM 返回的填充映射写入表格，返回填写的字段数；grid 为已构建的单元格网格（可选）"""
+        filled_count = 0
+        # 锚点坐标来自 _preprocess_table 的单元格网格，这里同样一次性构建网格后按下标取单元格；
+        # table.cell() 每次调用都会重建整表单元格数组
+        if grid is None:
+            grid = self._table_cell_grid(table)
+        for anchor_id, value in fill_map.items():
+            if anchor_id in anchor_map:
+                try:
+                    row, col = anchor_map[anchor_id]
+                    cell = grid[row][col]
+                    
+                    # 检查是否需要追加模式 (Append Mode)
+                    # 如果原单元格包含类似 "1. xxx (不超过xx字)" 的指令性文本，且 LLM 返回的内容不包含该头信息，则追加
+                    original_text = cell.text.strip()
+                    should_append = False
+                    
+                    # 识别指令性表头特征：
+                    # 1. 以数字开头 (1. / 1、 / 1 )
+                    # 2. 包含字数限制说明 (不超过...字)
+                    # 3. 新增：基于长度和数字开头的宽松匹配，与 _is_potential_slot 保持一致
+                    # 正则前先做廉价的字符检查：序号规则要求以数字开头，字数限制规则要求包含“不超过”，
+                    # 大多数普通单元格无需执行任何正则（字数限制正则含多段 .*? 回溯）
+                    starts_with_digit = len(original_text) > 0 and original_text[0].isdigit()
+                    if len(original_text) > 0 and (
+                        (starts_with_digit and _INSTR_HEADER_RE.match(original_text)) or 
+                        ('不超过' in original_text and _CHAR_LIMIT_RE.search(original_text)) or
+                        (starts_with_digit and len(original_text) > 5 and _SLOT_NUMBERED_RE.match(original_text))
+                    ):
+                        # 进一步检查：如果 LLM 返回的值已经包含了原文本（或者原文本的前一部分），则不需要追加，直接覆盖即可
+                        # 简单的模糊检查
+                        clean_val = str(value).strip()
+                        if clean_val.startswith(original_text[:min(10, len(original_text))]):
+                            should_append = False
+                        else:
+                            should_append = True
+                    
+                    if should_append:
+                        logger.info(f"检测到指令性表头，采用追加模式: {anchor_id}")
+                        
+                        # 1. 尝试从现有标题（第一段）提取样式
+                        font_style = {}
+                        if cell.paragraphs and cell.paragraphs[0].runs:
+                            font_style = self._extract_run_style(cell.paragraphs[0].runs[0])
+                            logger.info(f"锚点 {anchor_id}: 追加模式下，成功从标题提取字体样式: {font_style}")
+                        
+                        # 2. 追加新段落
+                        # 注意：add_paragraph 会在单元格末尾添加新段落
+                        new_para = cell.add_paragraph(str(value))
+                        
+                        # 3. 应用样式
+                        if font_style:
+                            for run in new_para.runs:
+                                self._apply_run_style(run, font_style)
+                    else:
+                        # 尝试保留原有样式
+                        filled_via_smart = False
+                        # cell.paragraphs 每次访问都会重新构造段落列表，只取一次
+                        paragraphs = cell.paragraphs
+                        if paragraphs:
+                            # 优先尝试智能下划线填充
+                            if self._smart_fill_paragraph(paragraphs[0], value):
+                                filled_via_smart = True
+                        
+                        if not filled_via_smart:
+                            # 准备填充的值
+                            clean_val = str(value).strip()
+                            
+                            # === Label 保护逻辑 ===
+                            # 检查原文本是否包含 Label（以冒号结尾的前缀）
+                            # 常见 Label 格式： "Label：" 或 "Label:"
+                            # 且 Label 长度不应过长（例如不超过 10 个字符）
+                            label_match = _LABEL_PREFIX_RE.match(original_text)
+                            if label_match:
+                                label_prefix = label_match.group(1)
+                                # 如果新值没有以这个 Label 开头，则补上
+                                # 避免重复：如果 LLM 返回了 "Label: value"，就不需要补
+                                if not clean_val.startswith(label_prefix):
+                                     # 特殊情况：如果原文本是 "起始：   年   月"，而新文本是 "2021年9月"
+                                     # 我们希望变成 "起始：2021年9月"
+                                     clean_val = label_prefix + clean_val
+                                     logger.info(f"锚点 {anchor_id}: 触发Label保护，已自动补全前缀 '{label_prefix}'")
+
+                            if paragraphs:
+                                # 获取第一段
+                                first_para = paragraphs[0]
+                                runs = first_para.runs
+                                
+                                # 调试信息：检查Runs状态
+                                if not runs:
+                                    logger.info(f"锚点 {anchor_id}: 单元格段落无 Runs (可能是空单元格)，无法提取预设样式。建议在模板中输入一个空格并设置样式。")
+                                
+                                # 尝试提取字体样式（从第一个Run）
+                                font_style = {}
+                                if runs:
+                                    font_style = self._extract_run_style(runs[0])
+                                else:
+                                    # 如果当前单元格为空（无Run），尝试从段落属性(pPr)中提取预设的字符样式
+                                    # 这通常是用户在空单元格中设置的格式
+                                    font_style = self._extract_paragraph_char_style(first_para)
+                                    if font_style:
+                                        logger.info(f"锚点 {anchor_id}: 成功从空单元格提取预设样式: {font_style}")
+                                    else:
+                                        logger.info(f"锚点 {anchor_id}: 当前单元格为空且无预设样式，将使用默认样式填充")
+
+                                # 清空段落内容但保留段落属性
+                                # 注意：first_para.clear() 会清除所有runs，但保留段落样式
+                                first_para.clear()
+                                
+                                # --- Fix: 清除后续段落，防止多段落单元格出现内容残留 ---
+                                # 如果是全量替换模式，且新内容包含了换行，或者我们认为这是在替换整个单元格
+                                # 那么应该移除 cell.paragraphs[1:]
+                                # paragraphs 是开始时取得的列表副本，直接从单元格 XML 中逐个移除即可，
+                                # 无需每删一段都重新获取 cell.paragraphs
+                                # python-docx 没有直接的 delete_paragraph 方法，需要操作 XML 元素
+                                for p_to_remove in paragraphs[1:]:
+                                    try:
+                                        cell._tc.remove(p_to_remove._p)
+                                    except Exception as e:
+                                        logger.warning(f"清除残留段落失败: {e}")
+
+                                # 添加新内容
+                                # 如果 clean_val 包含换行符，add_run 不会自动换行，通常需要处理
+                                # 但这里我们可以简单地让 add_run 处理文本，或者手动分割段落
+                                # 如果 LLM 返回的内容确实包含换行，通常意味着它想表达多行结构
+                                # 简单处理：将 \n 替换为 python-docx 的换行符，或者分割 add_run
+                                # 不过 python-docx 的 run.text = "A\nB" 会被正确渲染为软回车还是？
+                                # 通常 docx 中段落间换行是真回车，run 内 \n 是软回车 (Wait, docx text usually doesn't handle \n as paragraph break well in runs)
+                                # 但为了保持一致性，如果之前是多段落，现在 LLM 返回单字符串带 \n，
+                                # 最好还是作为单段落内的软回车，或者重建段落结构。
+                                # 鉴于我们保留了 first_para，我们就在 first_para 里塞入内容。
+                                
+                                new_run = first_para.add_run(clean_val)
+                                
+                                # 应用字体样式
+                                if font_style:
+                                    self._apply_run_style(new_run, font_style)
+                            else:
+                                # 确保值为字符串
+                                cell.text = clean_val
+                        
+                    filled_count += 1
+                    logger.debug(f"表格锚点 {anchor_id} 已填充值: {value}")
+                except IndexError:
+                    logger.error(f"无效的单元格位置: {anchor_map.get(anchor_id)}")
+                except Exception as e:
+                    logger.error(f"字段填写异常: {anchor_id} - {str(e)}")
+            else:
+                logger.warning(f"LLM返回了不存在的表格锚点ID: {anchor_id}")
+        return filled_count
+
     def fill_document(self):
         if not self.doc or self.knowledge_dict is None:
             logger.error("文档或知识库未正确初始化")
@@ -668,166 +1204,55 @@ class AutoTable:
         #     logger.info("正文段落中未发现填空位")
 
         # --- 2. 处理表格 ---
+        # 第一阶段：Word 模板的“数字化”预处理（先预处理全部表格，再合并请求）
+        pending_tables = []
         for table_idx, table in enumerate(self.doc.tables):
             logger.info(f"正在处理第{table_idx + 1}个表格")
-            
-            # 第一阶段：Word 模板的“数字化”预处理
             table_markdown, anchor_map, id_to_text_map = self._preprocess_table(table)
             
             if not anchor_map:
                 logger.info("该表格未发现填空位，跳过")
                 continue
+            pending_tables.append((table_idx, table, table_markdown, anchor_map, id_to_text_map))
 
-            # 第二阶段：LLM 分析并直接返回填充映射
-            # 将知识库数据作为上下文传给 LLM，并传入已使用的实体列表
-            fill_map = self.analyze_tables_with_llm(table_markdown, self.knowledge_dict, id_to_text_map, used_contexts=used_identities)
-            
-            # 提取并记录本次使用的实体标识
-            identity = fill_map.pop("__identity__", None)
-            if identity:
-                used_identities.append(identity)
-                logger.info(f"表格 {table_idx + 1} 使用了实体: {identity}")
-            
-            for anchor_id, value in fill_map.items():
-                if anchor_id in anchor_map:
-                    try:
-                        row, col = anchor_map[anchor_id]
-                        cell = table.cell(row, col)
-                        
-                        # 检查是否需要追加模式 (Append Mode)
-                        # 如果原单元格包含类似 "1. xxx (不超过xx字)" 的指令性文本，且 LLM 返回的内容不包含该头信息，则追加
-                        original_text = cell.text.strip()
-                        should_append = False
-                        
-                        # 识别指令性表头特征：
-                        # 1. 以数字开头 (1. / 1、 / 1 )
-                        # 2. 包含字数限制说明 (不超过...字)
-                        # 3. 新增：基于长度和数字开头的宽松匹配，与 _is_potential_slot 保持一致
-                        if len(original_text) > 0 and (
-                            re.match(r'^\d+(\.\d+)*[、. ]', original_text) or 
-                            re.search(r'[（(].*?不超过.*?字.*?[)）]', original_text) or
-                            (re.match(r'^\d+[.、\s]', original_text) and len(original_text) > 5)
-                        ):
-                            # 进一步检查：如果 LLM 返回的值已经包含了原文本（或者原文本的前一部分），则不需要追加，直接覆盖即可
-                            # 简单的模糊检查
-                            clean_val = str(value).strip()
-                            if clean_val.startswith(original_text[:min(10, len(original_text))]):
-                                should_append = False
-                            else:
-                                should_append = True
-                        
-                        if should_append:
-                            logger.info(f"检测到指令性表头，采用追加模式: {anchor_id}")
-                            
-                            # 1. 尝试从现有标题（第一段）提取样式
-                            font_style = {}
-                            if cell.paragraphs and cell.paragraphs[0].runs:
-                                font_style = self._extract_run_style(cell.paragraphs[0].runs[0])
-                                logger.info(f"锚点 {anchor_id}: 追加模式下，成功从标题提取字体样式: {font_style}")
-                            
-                            # 2. 追加新段落
-                            # 注意：add_paragraph 会在单元格末尾添加新段落
-                            new_para = cell.add_paragraph(str(value))
-                            
-                            # 3. 应用样式
-                            if font_style:
-                                for run in new_para.runs:
-                                    self._apply_run_style(run, font_style)
-                        else:
-                            # 尝试保留原有样式
-                            filled_via_smart = False
-                            if cell.paragraphs:
-                                # 优先尝试智能下划线填充
-                                if self._smart_fill_paragraph(cell.paragraphs[0], value):
-                                    filled_via_smart = True
-                            
-                            if not filled_via_smart:
-                                # 准备填充的值
-                                clean_val = str(value).strip()
-                                
-                                # === Label 保护逻辑 ===
-                                # 检查原文本是否包含 Label（以冒号结尾的前缀）
-                                # 常见 Label 格式： "Label：" 或 "Label:"
-                                # 且 Label 长度不应过长（例如不超过 10 个字符）
-                                label_match = re.match(r'^([^:：]{1,10}[:：])', original_text)
-                                if label_match:
-                                    label_prefix = label_match.group(1)
-                                    # 如果新值没有以这个 Label 开头，则补上
-                                    # 避免重复：如果 LLM 返回了 "Label: value"，就不需要补
-                                    if not clean_val.startswith(label_prefix):
-                                         # 特殊情况：如果原文本是 "起始：   年   月"，而新文本是 "2021年9月"
-                                         # 我们希望变成 "起始：2021年9月"
-                                         clean_val = label_prefix + clean_val
-                                         logger.info(f"锚点 {anchor_id}: 触发Label保护，已自动补全前缀 '{label_prefix}'")
-
-                                if cell.paragraphs:
-                                    # 获取第一段
-                                    first_para = cell.paragraphs[0]
-                                    
-                                    # 调试信息：检查Runs状态
-                                    if not first_para.runs:
-                                        logger.info(f"锚点 {anchor_id}: 单元格段落无 Runs (可能是空单元格)，无法提取预设样式。建议在模板中输入一个空格并设置样式。")
-                                    
-                                    # 尝试提取字体样式（从第一个Run）
-                                    font_style = {}
-                                    if first_para.runs:
-                                        font_style = self._extract_run_style(first_para.runs[0])
-                                    else:
-                                        # 如果当前单元格为空（无Run），尝试从段落属性(pPr)中提取预设的字符样式
-                                        # 这通常是用户在空单元格中设置的格式
-                                        font_style = self._extract_paragraph_char_style(first_para)
-                                        if font_style:
-                                            logger.info(f"锚点 {anchor_id}: 成功从空单元格提取预设样式: {font_style}")
-                                        else:
-                                            logger.info(f"锚点 {anchor_id}: 当前单元格为空且无预设样式，将使用默认样式填充")
-
-                                    # 清空段落内容但保留段落属性
-                                    # 注意：first_para.clear() 会清除所有runs，但保留段落样式
-                                    first_para.clear()
-                                    
-                                    # --- Fix: 清除后续段落，防止多段落单元格出现内容残留 ---
-                                    # 如果是全量替换模式，且新内容包含了换行，或者我们认为这是在替换整个单元格
-                                    # 那么应该移除 cell.paragraphs[1:]
-                                    # 注意：在遍历列表时删除元素是危险的，应倒序删除
-                                    if len(cell.paragraphs) > 1:
-                                        for i in range(len(cell.paragraphs) - 1, 0, -1):
-                                            p_to_remove = cell.paragraphs[i]
-                                            # python-docx 没有直接的 delete_paragraph 方法
-                                            # 需要操作 XML 元素
-                                            try:
-                                                p_element = p_to_remove._element
-                                                p_element.getparent().remove(p_element)
-                                            except Exception as e:
-                                                logger.warning(f"清除残留段落失败: {e}")
-
-                                    # 添加新内容
-                                    # 如果 clean_val 包含换行符，add_run 不会自动换行，通常需要处理
-                                    # 但这里我们可以简单地让 add_run 处理文本，或者手动分割段落
-                                    # 如果 LLM 返回的内容确实包含换行，通常意味着它想表达多行结构
-                                    # 简单处理：将 \n 替换为 python-docx 的换行符，或者分割 add_run
-                                    # 不过 python-docx 的 run.text = "A\nB" 会被正确渲染为软回车还是？
-                                    # 通常 docx 中段落间换行是真回车，run 内 \n 是软回车 (Wait, docx text usually doesn't handle \n as paragraph break well in runs)
-                                    # 但为了保持一致性，如果之前是多段落，现在 LLM 返回单字符串带 \n，
-                                    # 最好还是作为单段落内的软回车，或者重建段落结构。
-                                    # 鉴于我们保留了 first_para，我们就在 first_para 里塞入内容。
-                                    
-                                    new_run = first_para.add_run(clean_val)
-                                    
-                                    # 应用字体样式
-                                    if font_style:
-                                        self._apply_run_style(new_run, font_style)
-                                else:
-                                    # 确保值为字符串
-                                    cell.text = clean_val
-                            
-                        filled_count += 1
-                        logger.debug(f"表格锚点 {anchor_id} 已填充值: {value}")
-                    except IndexError:
-                        logger.error(f"无效的单元格位置: {anchor_map.get(anchor_id)}")
-                    except Exception as e:
-                        logger.error(f"字段填写异常: {anchor_id} - {str(e)}")
-                else:
-                    logger.warning(f"LLM返回了不存在的表格锚点ID: {anchor_id}")
+        # 第二阶段：LLM 分析并直接返回填充映射
+        # 多个表格合并为一次请求，知识库和规则只发送一次；内容过长时按上限拆分为多批
+        # 将知识库数据作为上下文传给 LLM，并传入已使用的实体列表
+        batches = self._batch_tables(pending_tables)
+        if self.max_workers > 1 and len(batches) > 1:
+            # 并行请求：LLM 调用以网络等待为主，各批同时发出；各批只能看到开始前已使用的实体，
+            # 结构不同的表格在不同批次之间仍可能选中同一实体，以换取总耗时从“批数 × 单次延迟”降到约一次延迟
+            snapshot = list(used_identities)
+            # 结构相同的表格（如多个“完成人”表）在各批中的请求内容完全一样，会选中同一实体，也会命中同一条运行内缓存；
+            # 为每批记录前面批次中与其首个表格结构相同的表格数，作为偏移提示，使各批依次选择不同的实体
+            offsets = []
+            seen = {}
+            for batch in batches:
+                offsets.append(seen.get(batch[0][2], 0))
+                for item in batch:
+                    seen[item[2]] = seen.get(item[2], 0) + 1
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+                results = list(executor.map(lambda args: self._analyze_table_batch(args[0], snapshot, table_offset=args[1]),
+                                            zip(batches, offsets)))
+            for _, identities in results:
+                used_identities.extend(identities)
+            # 第三阶段：按表格顺序写回文档（python-docx 对象不是线程安全的，写入始终在当前线程进行）
+            for batch, (fill_maps, _) in zip(batches, results):
+                for (_, table, _, anchor_map, _), fill_map in zip(batch, fill_maps):
+                    filled_count += self._fill_table(table, anchor_map, fill_map)
+        else:
+            # 逐批请求时流式接收回复：每个锚点的值一解析出来就写入对应单元格，
+            # 写入与模型生成同时进行，回复结束时文档也基本填写完毕
+            for batch in batches:
+                grids = [self._table_cell_grid(item[1]) for item in batch]
+
+                def on_fill(pos, anchor_id, value, batch=batch, grids=grids):
+                    nonlocal filled_count
+                    _, table, _, anchor_map, _ = batch[pos]
+                    filled_count += self._fill_table(table, anchor_map, {anchor_id: value}, grid=grids[pos])
+
+                _, identities = self._analyze_table_batch(batch, used_identities, on_fill=on_fill)
+                used_identities.extend(identities)
                     
         logger.info(f"完成文档填充，共填写{filled_count}个字段")
         return True
@@ -838,11 +1263,12 @@ class AutoTable:
             return False
         if not filename:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            base_name = os.path.splitext(os.path.basename(self.word_template_path))[0]
+            base_name = os.path.splitext(os.path.basename(self.template_name))[0]
             filename = f"{base_name}_filled_{timestamp}.docx"
         output_path = os.path.join(self.output_folder, filename)
         try:
             self.doc.save(output_path)
+            self.output_path = output_path
             logger.info(f"文档已保存至: {output_path}")
             return True
         except Exception as e:
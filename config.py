@@ -9,3 +9,6 @@ OLLAMA_MODEL_NAME = "qwen2.5:14b"
 
 # 运行模式,手动选择
 RUN_MODE = "api"  # 可选值: "api" 或 "ollama"
+
+# LLM 并发请求数（Word 知识库分段提取时同时发出的请求数）
+LLM_MAX_WORKERS = 4
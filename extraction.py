@@ -1,78 +1,181 @@
 import os
-import pandas as pd
 from docx import Document
+from openpyxl import Workbook
 import logging
 
 import re
 
-import json
+import orjson
 
 logger = logging.getLogger(__name__)
 
-def extract_content_to_json(docx_path, output_json_path, llm_client):
+# 查找 "空格 + 中文键名 + 冒号" 的模式（clean_cell_text 用），模块加载时编译一次
+# 空白、汉字、冒号三类字符互不相交，使用占有量词（Python 3.11+ 标准库 re 支持）匹配结果不变，
+# 但匹配失败时不再回溯长空白串；旧版本 Python 回退为普通量词
+try:
+    _KV_SPLIT_RE = re.compile(r'\s++([\u4e00-\u9fa5]{2,10}+[：:])')
+except re.error:
+    _KV_SPLIT_RE = re.compile(r'\s+([\u4e00-\u9fa5]{2,10}[：:])')
+
+# 连续的空格/制表符（排版用的对齐空白），发送给 LLM 前压缩为一个空格
+_NS_RE = re.compile(r'[ \t]{2,}')
+
+# 分段请求或解析失败时写入结果的键（原文回退与错误信息），用于识别不完整的提取结果
+_FAILURE_KEY_RE = re.compile(r'(?:Raw_Content|Error)(?:_Chunk_\d+)?')
+
+# 智能提取时每个分段的 token 预算（估算值）
+CHUNK_MAX_TOKENS = 8000
+
+# 智能提取的 system 消息：角色与提取规则（静态内容，所有请求逐字节相同）
+EXTRACTION_SYSTEM_PROMPT = """
+你是一个专业的数据提取专家，擅长将非结构化文档转化为结构化数据。
+请分析用户提供的文档内容片段，将其提取为扁平化 JSON 键值对。
+
+要求：
+1. 区分短事实与长段落，短事实细粒度拆分，长段落保留原文。
+2. 列表类内容可保留为序号文本或拆分为键_1、键_2。
+3. 键名简洁规范，特定小标题直接用原标题。
+4. 处理 ' // ' 作为换行提示，合理还原。
+5. 仅返回 JSON 对象。
+"""
+
+def _estimate_tokens(text):
+    """
+    粗略估算文本的 token 数：中文等非 ASCII 字符约 1 字 1 token，ASCII 字符约 4 个 1 token。
+    ASCII 字符数通过 encode(..., 'ignore') 在 C 层统计，不逐字符循环。
+    """
+    ascii_count = len(text.encode('ascii', 'ignore'))
+    return (len(text) - ascii_count) + ascii_count / 4
+
+def _open_docx(source):
+    """打开 Word 文档（文件路径或文件对象），把后缀名被改成 .docx 的 .doc 文件转换为易懂的错误"""
+    try:
+        return Document(source)
+    except Exception as e:
+        error_msg = str(e)
+        if "no relationship of type" in error_msg or "File is not a zip file" in error_msg:
+            raise ValueError(f"文件格式不正确。请确保您上传的是真正的 .docx 文件，而不是直接修改后缀名的 .doc 文件。({error_msg})")
+        raise e
+
+def _walk_docx(doc):
+    """
+    一次遍历 Word 文档的页眉、页脚、正文段落和表格，按顺序产出 (kind, payload)：
+    ("header", 文本)、("footer", 文本)、("para", 文本)、("table_start", 表格序号)、("row", [单元格文本, ...])。
+    段落文本已去除首尾空白，空段落不产出；单元格为原始文本，语义与 row.cells 中各单元格的 text 一致：
+    横向合并的单元格按跨度重复，纵向合并的续行单元格取起始单元格的文本。
+    表格直接遍历底层 XML（tr/tc/p），不构造 _Row/_Cell/Paragraph 包装对象，合并单元格的文本只读取一次。
+    """
+    for section in doc.sections:
+        for para in section.header.paragraphs:
+            text = para.text.strip()
+            if text:
+                yield "header", text
+        for para in section.footer.paragraphs:
+            text = para.text.strip()
+            if text:
+                yield "footer", text
+
+    for para in doc.paragraphs:
+        text = para.text.strip()
+        if text:
+            yield "para", text
+
+    for i, table in enumerate(doc.tables):
+        yield "table_start", i
+        above = {} # 上一行 {网格起始列: 单元格文本}，用于解析纵向合并
+        for tr in table._tbl.tr_lst:
+            row_texts = []
+            current = {}
+            offset = tr.grid_before
+            for tc in tr.tc_lst:
+                text = above.get(offset) if tc.vMerge == "continue" else None
+                if text is None:
+                    # 与 cell.text 相同：各段落文本（含制表符、换行）以换行连接
+                    text = "\n".join(p.text for p in tc.p_lst)
+                span = tc.grid_span
+                current[offset] = text
+                row_texts.extend([text] * span)
+                offset += span
+            above = current
+            yield "row", row_texts
+
+def has_extraction_errors(data):
+    """
+    提取结果中是否包含失败的分段（Raw_Content_Chunk_N / Error_Chunk_N，或整体失败时的 Raw_Content / Error）。
+    extract_content_to_json 在部分分段失败时仍返回 True，这类不完整的结果不应缓存复用。
+    """
+    return isinstance(data, dict) and any(isinstance(k, str) and _FAILURE_KEY_RE.fullmatch(k) for k in data)
+
+def extract_content_to_json(docx_path, output_json_path, llm_client, max_workers=4):
     """
     使用 LLM 智能提取 Word 文档内容，生成扁平化的 JSON 知识库
+    各分段相互独立，最多以 max_workers 个并发请求调用 LLM
     """
     try:
-        try:
-            doc = Document(docx_path)
-        except Exception as e:
-            error_msg = str(e)
-            if "no relationship of type" in error_msg or "File is not a zip file" in error_msg:
-                raise ValueError(f"文件格式不正确。请确保您上传的是真正的 .docx 文件，而不是直接修改后缀名的 .doc 文件。({error_msg})")
-            raise e
+        doc = _open_docx(docx_path)
             
         full_text = []
+        raw_length = 0
+        table_marker = None # 当前表格的 [表格 N] 标记，表格出现第一行非空内容时才写入
+
+        def _add(line):
+            # token 数决定请求的费用和耗时：压缩对齐空白，跳过与上一行相同的重复行
+            nonlocal raw_length
+            raw_length += len(line) + 1
+            line = _NS_RE.sub(' ', line)
+            if not full_text or full_text[-1] != line:
+                full_text.append(line)
 
         # 1. 收集所有文本（页眉、页脚、正文、表格）
-        # 页眉
-        for section in doc.sections:
-            for para in section.header.paragraphs:
-                if para.text.strip():
-                    full_text.append(f"[页眉] {para.text.strip()}")
-            for para in section.footer.paragraphs:
-                if para.text.strip():
-                    full_text.append(f"[页脚] {para.text.strip()}")
-
-        # 正文
-        for para in doc.paragraphs:
-            if para.text.strip():
-                full_text.append(para.text.strip())
-
-        # 表格
-        for i, table in enumerate(doc.tables):
-            full_text.append(f"\n[表格 {i+1}]")
-            for row in table.rows:
+        for kind, payload in _walk_docx(doc):
+            if kind == "header":
+                _add(f"[页眉] {payload}")
+            elif kind == "footer":
+                _add(f"[页脚] {payload}")
+            elif kind == "para":
+                _add(payload)
+            elif kind == "table_start":
+                table_marker = f"\n[表格 {payload+1}]"
+            else:
                 # 使用 ' // ' 替换换行符，以便在保持单行结构的同时保留换行信息
-                row_text = " | ".join([cell.text.strip().replace('\n', ' // ') for cell in row.cells if cell.text.strip()])
+                cell_texts = (text.strip() for text in payload)
+                row_text = " | ".join(text.replace('\n', ' // ') for text in cell_texts if text)
                 if row_text:
-                    full_text.append(row_text)
+                    # 没有任何非空行的表格不输出标记（表格编号仍按文档中的顺序）
+                    if table_marker is not None:
+                        _add(table_marker)
+                        table_marker = None
+                    _add(row_text)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"文档文本压缩: {raw_length} -> {sum(len(line) + 1 for line in full_text)} 字符")
         
-        def _split_chunks(lines, max_chars=8000):
+        def _split_chunks(lines, max_tokens=CHUNK_MAX_TOKENS):
+            # 按估算 token 数而非字符数分段：中文内容与原先按 8000 字符切分基本一致，
+            # 英文、数字为主的内容每段可容纳更多行，减少 LLM 请求次数
+            # 保持原文顺序（标题与其下内容需在同一上下文中），不做重排装箱
             chunks = []
             buf = []
-            length = 0
+            tokens = 0
             for line in lines:
                 s = line if isinstance(line, str) else str(line)
-                if length + len(s) + 1 > max_chars and buf:
+                line_tokens = _estimate_tokens(s) + 1
+                if tokens + line_tokens > max_tokens and buf:
                     chunks.append("\n".join(buf))
                     buf = []
-                    length = 0
+                    tokens = 0
                 buf.append(s)
-                length += len(s) + 1
+                tokens += line_tokens
             if buf:
                 chunks.append("\n".join(buf))
             return chunks
 
         def _parse_json(text):
-            try:
-                start = text.find('{')
-                end = text.rfind('}') + 1
-                if start != -1 and end != -1:
-                    return json.loads(text[start:end])
-                raise ValueError("未找到JSON内容")
-            except Exception:
-                raise
+            start = text.find('{')
+            end = text.rfind('}') + 1
+            # rfind 未找到时 end 为 0，需与 start 比较才能识别
+            if start != -1 and end > start:
+                return orjson.loads(text[start:end])
+            raise ValueError("未找到JSON内容")
 
         def _merge(a, b):
             for k, v in b.items():
@@ -99,26 +202,27 @@ def extract_content_to_json(docx_path, output_json_path, llm_client):
         merged = {}
         raw_fallback = {}
 
+        messages_list = []
         for idx, chunk in enumerate(chunks, start=1):
+            # 提取规则对所有文档、所有分段都相同，放在 system 消息中；user 消息只包含分段序号和内容，
+            # 各次请求共享相同的前缀，便于服务端的前缀缓存（Prompt Caching）命中
             prompt = f"""
-            请分析以下文档内容片段（第{idx}/{total}段），将其提取为扁平化 JSON 键值对。
-            
-            文档内容片段：
+            以下是文档内容片段（第{idx}/{total}段）：
             {chunk}
-            
-            要求：
-            1. 区分短事实与长段落，短事实细粒度拆分，长段落保留原文。
-            2. 列表类内容可保留为序号文本或拆分为键_1、键_2。
-            3. 键名简洁规范，特定小标题直接用原标题。
-            4. 处理 ' // ' 作为换行提示，合理还原。
-            5. 仅返回 JSON 对象。
             """
-            messages = [
-                {"role": "system", "content": "你是一个专业的数据提取专家，擅长将非结构化文档转化为结构化数据。"},
+            messages_list.append([
+                {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
-            ]
+            ])
+
+        # 只需要回复中的 JSON 对象：流式接收，对象一完整就结束该请求，不等待模型输出后续说明文字
+        responses = llm_client.chat_completion_many(messages_list, temperature=0.1, max_workers=max_workers, json_only=True)
+
+        # 按原始分段顺序合并，保证结果与串行执行一致
+        for idx, (chunk, response) in enumerate(zip(chunks, responses), start=1):
             try:
-                response = llm_client.chat_completion(messages, temperature=0.1)
+                if isinstance(response, Exception):
+                    raise response
                 data = _parse_json(response)
                 merged = _merge(merged, data)
             except Exception as e:
@@ -129,8 +233,9 @@ def extract_content_to_json(docx_path, output_json_path, llm_client):
         if raw_fallback:
             final_data.update(raw_fallback)
 
-        with open(output_json_path, 'w', encoding='utf-8') as f:
-            json.dump(final_data, f, ensure_ascii=False, indent=4)
+        # orjson 直接输出 UTF-8 字节，比 json.dump 逐字符写入快得多
+        with open(output_json_path, 'wb') as f:
+            f.write(orjson.dumps(final_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
         logger.info(f"成功使用 LLM 提取数据到 {output_json_path}")
         return True
 
@@ -149,11 +254,14 @@ def clean_cell_text(text):
     
     text = text.strip()
     
+    # 大多数单元格是不含冒号的短标签，不可能匹配，直接返回
+    if ':' not in text and '：' not in text:
+        return text
+    
     # 正则策略：查找 "空格 + 中文键名 + 冒号" 的模式，将其前面的空格替换为换行符
     # 键名限制为 2-6 个汉字，避免误伤普通句子
     # 处理中文冒号和英文冒号
-    pattern = r'\s+([\u4e00-\u9fa5]{2,10}[：:])'
-    text = re.sub(pattern, r'\n\1', text)
+    text = _KV_SPLIT_RE.sub(r'\n\1', text)
     
     return text
 
@@ -162,64 +270,48 @@ def extract_tables_from_docx(docx_path, output_excel_path):
     从Word文档中提取表格和文本，保存为Excel文件
     """
     try:
-        try:
-            doc = Document(docx_path)
-        except Exception as e:
-            error_msg = str(e)
-            if "no relationship of type" in error_msg or "File is not a zip file" in error_msg:
-                raise ValueError(f"文件格式不正确。请确保您上传的是真正的 .docx 文件，而不是直接修改后缀名的 .doc 文件。({error_msg})")
-            raise e
-
-        # 1. 提取所有文本段落 (包括页眉页脚)
+        doc = _open_docx(docx_path)
+
+        # 1. 提取所有文本段落 (包括页眉页脚) 和表格，一次遍历完成
         text_content = []
-        
-        # 提取页眉页脚
-        for section in doc.sections:
-            # 页眉
-            for para in section.header.paragraphs:
-                 if para.text.strip():
-                    text_content.append({"Content": para.text.strip(), "Type": "Header"})
-            # 页脚
-            for para in section.footer.paragraphs:
-                 if para.text.strip():
-                    text_content.append({"Content": para.text.strip(), "Type": "Footer"})
-
-        # 正文段落
-        for para in doc.paragraphs:
-            if para.text.strip():
-                text_content.append({"Content": para.text.strip(), "Type": "Text"})
-        
-        # 2. 提取表格
-        tables_data = []
-        for i, table in enumerate(doc.tables):
-            # 尝试提取表格数据
-            # 假设第一行是表头
-            rows = []
-            if len(table.rows) > 0:
-                # 获取所有行数据
-                for row in table.rows:
-                    # 保留换行符，以便LLM更好地理解多行内容（如“主要贡献”、“奖励情况”）
-                    # 同时尝试智能拆分混在一起的 KV 对
-                    cell_data = [clean_cell_text(cell.text) for cell in row.cells]
-                    rows.append(cell_data)
-                
-                # 直接转换为 DataFrame，不假设第一行是表头
-                # 这样可以保留 Key-Value 类型的表格结构（如简历、登记表）
-                # 同时也解决了表头包含换行符导致的问题
-                df = pd.DataFrame(rows)
-                tables_data.append(df)
+        text_types = {"header": "Header", "footer": "Footer", "para": "Text"}
+        tables_rows = []
+        for kind, payload in _walk_docx(doc):
+            if kind in text_types:
+                text_content.append({"Content": payload, "Type": text_types[kind]})
+            elif kind == "table_start":
+                tables_rows.append([])
+            else:
+                # 保留换行符，以便LLM更好地理解多行内容（如“主要贡献”、“奖励情况”）
+                # 同时尝试智能拆分混在一起的 KV 对
+                tables_rows[-1].append([clean_cell_text(text) for text in payload])
+
+        # 2. 提取表格（跳过没有行的空表格）
+        # 按行原样写出，不假设第一行是表头
+        # 这样可以保留 Key-Value 类型的表格结构（如简历、登记表）
+        # 同时也解决了表头包含换行符导致的问题
+        tables_data = [rows for rows in tables_rows if rows]
 
         # 3. 写入Excel
-        with pd.ExcelWriter(output_excel_path, engine='openpyxl') as writer:
-            # 写入文本内容
-            if text_content:
-                df_text = pd.DataFrame(text_content)
-                df_text.to_excel(writer, sheet_name="Text_Content", index=False)
-            
-            # 写入表格 (不写入 Header，不写入 Index)
-            for i, df in enumerate(tables_data):
-                sheet_name = f"Table_{i+1}"
-                df.to_excel(writer, sheet_name=sheet_name, index=False, header=False)
+        # 数据只用于输出，直接用 openpyxl 逐行写入工作表，不经过 pandas（省去 DataFrame 构造和类型推断）
+        # 只写模式逐行写入文件，不在内存中为每个单元格保留 Cell 对象；新建时也不带默认的空白工作表
+        if not text_content and not tables_data:
+            # 只写模式会保存出没有任何工作表的文件，Excel 无法打开，按失败处理
+            raise ValueError("文档中没有可提取的文本或表格")
+        wb = Workbook(write_only=True)
+        # 写入文本内容（首行为列名）
+        if text_content:
+            ws = wb.create_sheet("Text_Content")
+            ws.append(["Content", "Type"])
+            for item in text_content:
+                ws.append([item["Content"], item["Type"]])
+        
+        # 写入表格 (不写入 Header，不写入 Index)
+        for i, rows in enumerate(tables_data):
+            ws = wb.create_sheet(f"Table_{i+1}")
+            for row in rows:
+                ws.append(row)
+        wb.save(output_excel_path)
                 
         logger.info(f"成功从 {docx_path} 提取数据到 {output_excel_path}")
         return True
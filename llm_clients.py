@@ -1,15 +1,94 @@
+import os
 import requests
 import json
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from ollama import Client
 
 logger = logging.getLogger(__name__)
 
+def _contains_json_object(text):
+    """回复中是否包含可解析的 JSON 对象（与调用方的解析方式一致：取第一个 { 到最后一个 } 之间的内容）"""
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        return False
+    try:
+        json.loads(text[start:end + 1])
+        return True
+    except ValueError:
+        return False
+
 class BaseLLMClient:
     """大语言模型客户端基类"""
     def chat_completion(self, messages, temperature=0.7):
         raise NotImplementedError("子类必须实现chat_completion方法")
 
+    def chat_completion_stream(self, messages, temperature=0.7):
+        """
+        流式返回回复文本片段，调用方可以边接收边处理。
+        不支持流式的客户端一次性返回完整回复（只产生一个片段）。
+        """
+        yield self.chat_completion(messages, temperature=temperature)
+
+    def chat_completion_json(self, messages, temperature=0.7):
+        """
+        用于只需要 JSON 对象的请求：流式接收回复，对象的括号一闭合就停止读取，
+        返回第一个 { 到与之匹配的 } 之间的文本，不再等待模型在 JSON 之后输出的说明文字。
+        回复中没有完整的 JSON 对象时返回接收到的全部文本，由调用方按原逻辑解析。
+        """
+        parts = []
+        depth = 0
+        in_string = False
+        escape = False
+        stream = self.chat_completion_stream(messages, temperature=temperature)
+        try:
+            for chunk in stream:
+                for i, c in enumerate(chunk):
+                    if in_string:
+                        if escape:
+                            escape = False
+                        elif c == "\\":
+                            escape = True
+                        elif c == '"':
+                            in_string = False
+                    elif c == '"':
+                        # 对象开始之前的引号属于说明文字，不影响括号计数
+                        in_string = depth > 0
+                    elif c == "{":
+                        depth += 1
+                    elif c == "}" and depth > 0:
+                        depth -= 1
+                        if depth == 0:
+                            parts.append(chunk[:i + 1])
+                            text = "".join(parts)
+                            return text[text.find("{"):]
+                parts.append(chunk)
+        finally:
+            # 提前结束时关闭流，释放连接，服务端随之停止生成
+            stream.close()
+        return "".join(parts)
+
+    def chat_completion_many(self, messages_list, temperature=0.7, max_workers=4, json_only=False):
+        """
+        并发执行多组对话请求，结果按输入顺序返回。
+        单个请求失败不会中断其余请求，对应位置返回异常对象，由调用方自行处理。
+        json_only 为 True 时通过 chat_completion_json 请求，JSON 对象一完整就返回。
+        """
+        call = self.chat_completion_json if json_only else self.chat_completion
+
+        def _call(messages):
+            try:
+                return call(messages, temperature=temperature)
+            except Exception as e:
+                return e
+
+        if max_workers <= 1 or len(messages_list) <= 1:
+            return [_call(messages) for messages in messages_list]
+        # LLM 请求为 I/O 密集型，线程等待网络时会释放 GIL
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(messages_list))) as executor:
+            return list(executor.map(_call, messages_list))
+
 class APIClient(BaseLLMClient):
     """OpenAI兼容API客户端"""
     def __init__(self, api_base_url, api_key, model_name):
@@ -20,6 +99,9 @@ class APIClient(BaseLLMClient):
             "Content-Type": "application/json",
             "Authorization": f"Bearer {api_key}"
         }
+        # 复用连接池，多次请求之间保持 HTTP keep-alive，避免重复建立 TCP/TLS 连接
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
 
     def chat_completion(self, messages, temperature=0.7):
         url = f"{self.api_base_url}/chat/completions"
@@ -29,7 +111,7 @@ class APIClient(BaseLLMClient):
             "temperature": temperature
         }
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, json=payload)
             response.raise_for_status()
             return response.json()["choices"][0]["message"]["content"]
         except requests.exceptions.RequestException as e:
@@ -39,9 +121,41 @@ class APIClient(BaseLLMClient):
             logger.error(f"API响应格式异常: {str(e)}")
             raise
 
+    def chat_completion_stream(self, messages, temperature=0.7):
+        url = f"{self.api_base_url}/chat/completions"
+        payload = {
+            "model": self.model_name,
+            "messages": messages,
+            "temperature": temperature,
+            "stream": True
+        }
+        try:
+            # 服务端按 SSE 格式逐行推送增量：data: {...}，以 data: [DONE] 结束
+            with self.session.post(url, json=payload, stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        break
+                    choices = json.loads(data).get("choices")
+                    if not choices:
+                        continue
+                    content = (choices[0].get("delta") or {}).get("content")
+                    if content:
+                        yield content
+        except requests.exceptions.RequestException as e:
+            logger.error(f"API请求失败: {str(e)}")
+            raise
+        except ValueError as e:
+            logger.error(f"API响应格式异常: {str(e)}")
+            raise
+
 class OllamaClient(BaseLLMClient):
     """本地Ollama客户端"""
     def __init__(self, host, model_name):
+        self.host = host
         self.client = Client(host=host)
         self.model_name = model_name
 
@@ -55,4 +169,119 @@ class OllamaClient(BaseLLMClient):
             return response['message']['content']
         except Exception as e:
             logger.error(f"Ollama调用失败: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+
+    def chat_completion_stream(self, messages, temperature=0.3):
+        try:
+            for part in self.client.chat(
+                model=self.model_name,
+                messages=messages,
+                options={"temperature": temperature},
+                stream=True
+            ):
+                content = part['message']['content']
+                if content:
+                    yield content
+        except Exception as e:
+            logger.error(f"Ollama调用失败: {str(e)}")
+            raise
+
+class CachedLLMClient(BaseLLMClient):
+    """
+    带磁盘响应缓存的客户端包装：同一后端、模型、消息和温度的请求直接返回已缓存的回复。
+    适合反复调整模板、重复处理相同文档的场景，避免重复消耗 token。
+    调用方都需要 JSON 结果，只缓存包含完整 JSON 对象的回复；无法解析的回复下次重新请求，不会被反复重放。
+    """
+    def __init__(self, client, cache_dir):
+        self.client = client
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, messages, temperature, json_only=False):
+        key = {
+            "backend": type(self.client).__name__,
+            "endpoint": getattr(self.client, "api_base_url", None) or getattr(self.client, "host", None),
+            "model": getattr(self.client, "model_name", None),
+            "messages": messages,
+            "temperature": temperature
+        }
+        if json_only:
+            # 截取后的 JSON 与完整回复分开缓存，普通请求不会命中被截断的内容
+            key["json_only"] = True
+        key = json.dumps(key, ensure_ascii=False, sort_keys=True)
+        # 缓存键无需抗碰撞的密码学强度，BLAKE2b 比 SHA-256 更快
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def _load(self, cache_path):
+        """读取缓存的回复，未命中返回 None"""
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                content = json.load(f)["content"]
+            logger.info(f"命中LLM响应缓存: {os.path.basename(cache_path)}")
+            return content
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _store(self, cache_path, messages, content):
+        if not _contains_json_object(content):
+            logger.warning(f"LLM回复中没有完整的JSON对象，不写入缓存: {os.path.basename(cache_path)}")
+            return
+        try:
+            # 先写临时文件再替换，避免并发请求读到不完整的缓存
+            tmp_path = f"{cache_path}.{os.getpid()}.{id(messages)}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"content": content}, f, ensure_ascii=False)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"写入LLM响应缓存失败: {str(e)}")
+
+    def chat_completion(self, messages, temperature=None):
+        cache_path = self._cache_path(messages, temperature)
+        content = self._load(cache_path)
+        if content is not None:
+            return content
+
+        # 未传温度时沿用被包装客户端自身的默认值
+        if temperature is None:
+            content = self.client.chat_completion(messages)
+        else:
+            content = self.client.chat_completion(messages, temperature=temperature)
+        self._store(cache_path, messages, content)
+        return content
+
+    def chat_completion_json(self, messages, temperature=None):
+        """
+        命中缓存时直接返回；否则由被包装客户端提前截取 JSON 对象后写入缓存。
+        （流式接口在调用方中途停止读取时不会写入缓存，因此这里单独处理）
+        """
+        cache_path = self._cache_path(messages, temperature, json_only=True)
+        content = self._load(cache_path)
+        if content is not None:
+            return content
+
+        if temperature is None:
+            content = self.client.chat_completion_json(messages)
+        else:
+            content = self.client.chat_completion_json(messages, temperature=temperature)
+        self._store(cache_path, messages, content)
+        return content
+
+    def chat_completion_stream(self, messages, temperature=None):
+        """命中缓存时一次性返回；否则透传被包装客户端的流式片段，完整接收后再写入缓存"""
+        cache_path = self._cache_path(messages, temperature)
+        content = self._load(cache_path)
+        if content is not None:
+            yield content
+            return
+
+        if temperature is None:
+            stream = self.client.chat_completion_stream(messages)
+        else:
+            stream = self.client.chat_completion_stream(messages, temperature=temperature)
+        parts = []
+        for chunk in stream:
+            parts.append(chunk)
+            yield chunk
+        # 调用方中途停止读取时不会执行到这里，不完整的回复不会进入缓存
+        self._store(cache_path, messages, "".join(parts))
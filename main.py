@@ -1,7 +1,12 @@
+import os
 import logging
-from config import RUN_MODE, API_BASE_URL, API_KEY, API_MODEL_NAME, OLLAMA_HOST, OLLAMA_MODEL_NAME
+import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from config import RUN_MODE, API_BASE_URL, API_KEY, API_MODEL_NAME, OLLAMA_HOST, OLLAMA_MODEL_NAME, LLM_MAX_WORKERS
 from llm_clients import APIClient, OllamaClient
 from autotable import AutoTable
+from extraction import extract_content_to_json
 
 # 配置日志系统
 logging.basicConfig(
@@ -14,32 +19,73 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-if __name__ == "__main__":
+@functools.lru_cache(maxsize=1)
+def get_llm_client():
+    """
+    按配置创建 LLM 客户端，进程内只创建一次。
+    在同一进程中多次调用（如脚本批量处理多个文件）时复用同一客户端及其 HTTP 连接池。
+    """
     if RUN_MODE == "api":
         logger.info("使用 API 模式")
-        llm_client = APIClient(
+        return APIClient(
             api_base_url=API_BASE_URL,
             api_key=API_KEY,
             model_name=API_MODEL_NAME
         )
-    elif RUN_MODE == "ollama":
+    if RUN_MODE == "ollama":
         logger.info("使用 Ollama 模式")
-        llm_client = OllamaClient(
+        return OllamaClient(
             host=OLLAMA_HOST,
             model_name=OLLAMA_MODEL_NAME
         )
-    else:
-        raise ValueError(f"无效的运行模式: {RUN_MODE}")
+    raise ValueError(f"无效的运行模式: {RUN_MODE}")
 
-    # 支持自动切换 .xlsx 或 .json
-    kb_path = "知识库/复杂表格.xlsx"
-    if not os.path.exists(kb_path):
-        kb_path = "知识库/extracted_knowledge.json"
-
-    auto_table = AutoTable(
-        knowledge_base_path=kb_path,
-        word_template_path="模版/复杂表格.docx",
-        llm_client=llm_client
+def extract_batch(docx_dir, llm_client, max_workers=LLM_MAX_WORKERS):
+    """
+    批量将目录下的 Word 知识库提取为 JSON（输出到 .docx 同目录、同名 .json 文件）。
+    LLM 请求以网络等待为主，多个文档用线程并发处理；同时在途的请求数不超过 max_workers。
+    """
+    paths = sorted(
+        os.path.join(docx_dir, name) for name in os.listdir(docx_dir)
+        # 跳过 Word 打开文档时生成的 ~$ 临时文件
+        if name.lower().endswith(".docx") and not name.startswith("~$")
     )
+    if not paths:
+        logger.warning(f"目录中没有 .docx 文件: {docx_dir}")
+        return {}
+
+    # 多个文档并发时各文档内部的分段逐个请求，单个文档时分段之间并发
+    chunk_workers = 1 if len(paths) > 1 else max_workers
+
+    def _extract(path):
+        output_path = os.path.splitext(path)[0] + ".json"
+        return extract_content_to_json(path, output_path, llm_client, max_workers=chunk_workers)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(paths)))) as executor:
+        results = dict(zip(paths, executor.map(_extract, paths)))
+    succeeded = sum(1 for ok in results.values() if ok)
+    logger.info(f"批量提取完成: 成功 {succeeded}/{len(paths)} 个文档")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AutoTable 自动填表")
+    parser.add_argument("--batch", metavar="DIR", help="批量将目录下的 .docx 知识库提取为 JSON，不执行填表")
+    args = parser.parse_args()
+
+    llm_client = get_llm_client()
+
+    if args.batch:
+        extract_batch(args.batch, llm_client)
+    else:
+        # 支持自动切换 .xlsx 或 .json
+        kb_path = "知识库/复杂表格.xlsx"
+        if not os.path.exists(kb_path):
+            kb_path = "知识库/extracted_knowledge.json"
+
+        auto_table = AutoTable(
+            knowledge_base_path=kb_path,
+            word_template_path="模版/复杂表格.docx",
+            llm_client=llm_client
+        )
 
-    auto_table.run()
\ No newline at end of file
+        auto_table.run()
\ No newline at end of file